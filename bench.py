@@ -0,0 +1,241 @@
+"""
+Memory Agent Bot - Benchmarks
+=============================
+מדידת latency ו-throughput של פונקציות האחסון והחיפוש על קורפוס סינתטי.
+
+רץ אופליין לגמרי: ספק ה-embeddings הדטרמיניסטי (EMBEDDING_PROVIDER=hashing),
+ו-MongoDB מקומי (--mongo-uri) או mongomock בזיכרון (ברירת מחדל).
+
+    python bench.py --sizes 1k,10k --output bench_results.json
+    python bench.py --mongo-uri mongodb://localhost:27017 --sizes 100k,1m --dimensions 256
+    python bench.py --compare old.json new.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timedelta
+from typing import Dict, Any, Callable
+
+WORDS = (
+    "redis cache mongo index query timeout render deploy docker webhook "
+    "async await thread pool retry backoff latency memory leak profiler "
+    "python fastapi uvicorn telegram embedding vector search cursor page "
+    "aggregate pipeline shard replica token limit queue worker lock race "
+    "condition migration schema ttl batch bulk insert update delete stats"
+).split()
+TAGS = WORDS[:40]
+SEARCH_TEXT = "redis cache timeout"
+OWNER_ID = 1  # ADMIN_TELEGRAM_ID של הסביבה האופליין
+
+
+def parse_size(value: str) -> int:
+    """'10k' / '1m' / '5000' -> מספר."""
+    value = value.strip().lower()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(value[-1:], 1)
+    return int(float(value.rstrip("km")) * multiplier)
+
+
+def setup_environment(args: argparse.Namespace) -> Any:
+    """הגדרת סביבה אופליין וטעינת main."""
+    os.environ.update({
+        "BOT_TOKEN": "0:offline-benchmark",
+        "PUBLIC_URL": "http://localhost",
+        "ADMIN_TELEGRAM_ID": "1",
+        "EMBEDDING_PROVIDER": "hashing",
+        "MONGODB_URI": args.mongo_uri or "mongodb://localhost",
+        "DB_NAME": args.db_name,
+        "SEARCH_BACKEND": args.backend,
+        "EMBEDDING_DIMENSIONS": str(args.dimensions),
+        "TAG_COUNTS_REBUILD_HOURS": "0",
+    })
+
+    if not args.mongo_uri:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is required without --mongo-uri (pip install mongomock)")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+    import main
+    logging.getLogger(main.__name__).setLevel(logging.WARNING)
+    return main
+
+
+def generate_corpus(main: Any, size: int, rng: random.Random, batch_size: int = 1000) -> None:
+    """מילוי ה-collection בזיכרונות סינתטיים."""
+    for name in (main.memories.name, main.tag_counts.name, main.embedding_cache.name):
+        main.get_db()[name].delete_many({})
+    main._local_index = None
+
+    start = datetime(2024, 1, 1)
+    for offset in range(0, size, batch_size):
+        docs = []
+        for i in range(offset, min(offset + batch_size, size)):
+            doc = {
+                "owner_id": OWNER_ID,
+                "title": " ".join(rng.choices(WORDS, k=rng.randint(3, 6))),
+                "solution": " ".join(rng.choices(WORDS, k=rng.randint(20, 60))),
+                "tags": rng.sample(TAGS, k=rng.randint(1, 4)),
+                "context": "",
+                "code": "",
+                "created_at": start + timedelta(seconds=i * 37),
+            }
+            doc["updated_at"] = doc["created_at"]
+            embedding = main.make_embedding(main.build_embedding_text(doc))
+            doc.update(main.encode_embedding(embedding))
+            doc.update(main.embedding_metadata())
+            docs.append(doc)
+        main.memories.insert_many(docs, ordered=False)
+
+    main.rebuild_tag_counts()
+
+
+def measure(func: Callable[[], Any], iterations: int, warmup: int) -> Dict[str, float]:
+    """latency (ms) באחוזונים ו-throughput (פעולות לשנייה, thread יחיד)."""
+    for _ in range(warmup):
+        func()
+
+    samples = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1000)
+    elapsed = time.perf_counter() - started
+
+    samples.sort()
+
+    def percentile(p: float) -> float:
+        return round(samples[min(len(samples) - 1, int(p / 100 * len(samples)))], 3)
+
+    return {
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "mean_ms": round(sum(samples) / len(samples), 3),
+        "ops_per_sec": round(iterations / elapsed, 1),
+    }
+
+
+def run_size(main: Any, size: int, args: argparse.Namespace, in_memory: bool) -> Dict[str, Any]:
+    """מדידת כל הפונקציות על קורפוס בגודל נתון."""
+    rng = random.Random(size)
+    t0 = time.perf_counter()
+    generate_corpus(main, size, rng)
+    load_seconds = round(time.perf_counter() - t0, 2)
+
+    # עמוד באמצע הרשימה - בודק שהדפדוף לא מאט עם העומק
+    middle = main.memories.find({"owner_id": OWNER_ID}, {"created_at": 1}).sort(
+        [("created_at", -1), ("_id", -1)]).skip(size // 2).limit(1)
+    middle_cursor = main.encode_cursor(next(iter(middle)))
+
+    operations = {
+        "search_memories_vector": lambda: main.search_memories_vector(OWNER_ID, SEARCH_TEXT, 5),
+        "search_memories_text": lambda: main.search_memories_text(OWNER_ID, SEARCH_TEXT, 5),
+        "search_by_tag": lambda: main.search_by_tag(OWNER_ID, rng.choice(TAGS), 20),
+        "get_recent_memories": lambda: main.get_recent_memories(OWNER_ID, 10),
+        "get_recent_memories_page_deep": lambda: main.get_recent_memories_page(OWNER_ID, 10, middle_cursor),
+        # בלי ה-cache של הסטטיסטיקות - מודדים את השאילתה עצמה
+        "get_stats": lambda: (main.forget_stats(OWNER_ID), main.get_stats(OWNER_ID)),
+    }
+
+    results: Dict[str, Any] = {"corpus_load_seconds": load_seconds}
+    for name, func in operations.items():
+        if in_memory and name == "search_memories_text":
+            results[name] = {"skipped": "mongomock has no $text support; use --mongo-uri"}
+            continue
+        results[name] = measure(func, args.iterations, args.warmup)
+        print(f"  {name:32s} p50={results[name]['p50_ms']:>9.3f}ms  "
+              f"p95={results[name]['p95_ms']:>9.3f}ms  {results[name]['ops_per_sec']:>9.1f} ops/s")
+    return results
+
+
+def git_commit() -> str:
+    """ה-commit הנוכחי (להשוואה בין ריצות)."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(old_path: str, new_path: str) -> None:
+    """השוואת p50/p95 בין שתי ריצות."""
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = json.load(f)
+
+    print(f"{old['meta']['commit']} -> {new['meta']['commit']}")
+    for size, ops in new["results"].items():
+        print(f"\n[{size}]")
+        for name, result in ops.items():
+            before = old["results"].get(size, {}).get(name)
+            if not isinstance(result, dict) or "p50_ms" not in result:
+                continue
+            if not before or "p50_ms" not in before:
+                print(f"  {name:32s} (new)")
+                continue
+            for key in ("p50_ms", "p95_ms"):
+                change = (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+                print(f"  {name:32s} {key}: {before[key]:>9.3f} -> {result[key]:>9.3f} ({change:+.1f}%)")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Memory Agent Bot benchmarks")
+    parser.add_argument("--sizes", default="1k,10k", help="גדלי קורפוס, למשל 1k,10k,100k,1m")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--backend", choices=["local", "atlas"], default="local",
+                        help="atlas דורש --mongo-uri של Atlas (ב-mongomock אין $vectorSearch)")
+    parser.add_argument("--mongo-uri", default="", help="MongoDB מקומי (ברירת מחדל: mongomock בזיכרון)")
+    parser.add_argument("--db-name", default="memory_bot_bench")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="השוואת שני קבצי תוצאות")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.backend == "atlas" and not args.mongo_uri:
+        # בלי Atlas אמיתי כל חיפוש נופל לחיפוש הטקסט, והתוצאה לא מודדת את $vectorSearch
+        parser.error("--backend atlas requires --mongo-uri pointing at an Atlas cluster")
+
+    main = setup_environment(args)
+    in_memory = not args.mongo_uri
+
+    report: Dict[str, Any] = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "store": "mongomock" if in_memory else "mongodb",
+            "backend": args.backend,
+            "embedding_provider": "hashing",
+            "dimensions": args.dimensions,
+            "iterations": args.iterations,
+        },
+        "results": {},
+    }
+    for label in args.sizes.split(","):
+        size = parse_size(label)
+        print(f"[{label}] generating {size} memories...")
+        report["results"][label] = run_size(main, size, args, in_memory)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -9,15 +9,47 @@ Version: 1.0.0
 """
 
 import os
+import re
+import sys
 import json
+import math
+import random
+import bisect
+import heapq
+import asyncio
+import functools
+import hmac
+import base64
+import hashlib
+import argparse
 import logging
-from datetime import datetime
-from typing import List, Optional, Dict, Any
+import time
+import threading
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, Optional, Dict, Any, Callable, Iterable, Iterator, AsyncIterator, Tuple
 
+PROCESS_STARTED = time.monotonic()  # לפני ה-imports הכבדים - למדידת cold start
+
+try:
+    import numpy as np
+except ImportError:  # נדרש רק ל-SEARCH_BACKEND=local
+    np = None
+
+import bson
+from bson import ObjectId
+from bson.binary import Binary, BinaryVectorDtype
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, HTTPException
-from pymongo import MongoClient, DESCENDING
-from openai import OpenAI
+from fastapi import FastAPI, Request, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from pymongo import MongoClient, DESCENDING, TEXT, UpdateOne
+from pymongo import ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from openai import OpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from prometheus_client import Counter as MetricCounter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
 
 from telegram import (
     Update,
@@ -44,20 +76,127 @@ PUBLIC_URL = os.getenv("PUBLIC_URL")
 MONGODB_URI = os.getenv("MONGODB_URI")
 DB_NAME = os.getenv("DB_NAME", "memory_bot")
 ADMIN_TELEGRAM_ID = int(os.getenv("ADMIN_TELEGRAM_ID", "0"))
+# משתמשים נוספים שמורשים להשתמש בבוט (מופרדים בפסיקים). לכל משתמש זיכרונות משלו.
+ALLOWED_USER_IDS = {int(u) for u in os.getenv("ALLOWED_USER_IDS", "").replace(" ", "").split(",") if u}
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "change-me")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Embedding cache
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1000"))
+EMBEDDING_CACHE_TTL_DAYS = int(os.getenv("EMBEDDING_CACHE_TTL_DAYS", "30"))
+
+# גודל ה-thread pool לקריאות חוסמות (MongoDB / OpenAI)
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "8"))
+
+# טוקן ל-API הניהולי (import וכו'). אם לא מוגדר - ה-endpoints חסומים.
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "")
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+
+# מנוע חיפוש וקטורי: atlas ($vectorSearch) או local (אינדקס NumPy בתהליך)
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "atlas").lower()
+# תיקייה לשמירת האינדקס המקומי (memory-mapped). ריק = בזיכרון בלבד.
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "")
+# כל כמה דקות האינדקס המקומי מושך embeddings שנכתבו בתהליכים אחרים (0 = רק בעלייה)
+LOCAL_INDEX_REFRESH_MINUTES = float(os.getenv("LOCAL_INDEX_REFRESH_MINUTES", "1"))
+# תור עדכוני webhook: מספר workers, גודל תור כולל, וזמן ניקוז בכיבוי (שניות)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "200"))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "10"))
+# כל כמה שעות לבנות מחדש את ספירת התגיות (תיקון סטיות). 0 = לא לבנות.
+TAG_COUNTS_REBUILD_HOURS = float(os.getenv("TAG_COUNTS_REBUILD_HOURS", "24"))
+# אחסון embeddings: float (מערך doubles), int8 או binary (וקטור מכומת + float32 לדירוג מחדש)
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "float").lower()
+# כמה מועמדים לשלוף לכל תוצאה לפני דירוג מחדש בדיוק מלא
+RESCORE_FACTOR = int(os.getenv("RESCORE_FACTOR", "4"))
+# ספק ה-embeddings: openai, local (מודל sentence-transformers על CPU) או hashing
+# (דטרמיניסטי, בלי מודל - לבדיקות ולעבודה אופליין). לכל ספק מודל ומימדים משלו.
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai").lower()
+EMBEDDING_PROVIDER_DEFAULTS = {
+    "openai": ("text-embedding-3-small", 1536),
+    "local": ("sentence-transformers/all-MiniLM-L6-v2", 384),
+    "hashing": ("hashing-v1", 256),
+}
+# מודל ומימדי ה-embedding (ברירת מחדל לפי הספק), השדה שממנו מחפשים ושם אינדקס ה-Atlas
+_provider_model, _provider_dimensions = EMBEDDING_PROVIDER_DEFAULTS.get(EMBEDDING_PROVIDER, ("", 0))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL") or _provider_model
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS") or _provider_dimensions)
+# תהליכים לספקים המקומיים (local / hashing). 0 = באותו תהליך, ב-thread pool.
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "0"))
+EMBEDDING_FIELD = os.getenv("EMBEDDING_FIELD", "embedding")
+VECTOR_INDEX_NAME = os.getenv("VECTOR_INDEX_NAME", "memories_vector_index")
+# מיגרציית מימדים: שדה ומימדים חדשים שנכתבים במקביל (dual-write) עד המעבר
+EMBEDDING_NEXT_FIELD = os.getenv("EMBEDDING_NEXT_FIELD", "")
+EMBEDDING_NEXT_DIMENSIONS = int(os.getenv("EMBEDDING_NEXT_DIMENSIONS") or 0)
+# Re-embedding: מספר קבוצות במקביל ומגבלת טוקנים לדקה
+REEMBED_CONCURRENCY = int(os.getenv("REEMBED_CONCURRENCY", "4"))
+REEMBED_TOKENS_PER_MINUTE = int(os.getenv("REEMBED_TOKENS_PER_MINUTE", "1000000"))
+# מצב חיפוש: vector (וקטורי בלבד) או hybrid (וקטורי + מילות מפתח, RRF)
+SEARCH_MODE = os.getenv("SEARCH_MODE", "vector").lower()
+# cache של מסמכים מוכנים לתצוגה (לפי _id): גודל ותוקף בשניות
+DOC_CACHE_SIZE = int(os.getenv("DOC_CACHE_SIZE", "256"))
+DOC_CACHE_SECONDS = float(os.getenv("DOC_CACHE_SECONDS", "60"))
+# קריאות embeddings: timeout לקריאה (שניות), ניסיונות חוזרים, ו-circuit breaker
+# (כמה כשלונות רצופים פותחים אותו, וכמה שניות הוא נשאר פתוח)
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "5"))
+EMBEDDING_RETRIES = int(os.getenv("EMBEDDING_RETRIES", "2"))
+EMBEDDING_BREAKER_THRESHOLD = int(os.getenv("EMBEDDING_BREAKER_THRESHOLD", "5"))
+EMBEDDING_BREAKER_COOLDOWN = float(os.getenv("EMBEDDING_BREAKER_COOLDOWN", "30"))
+# כל כמה דקות להשלים embeddings לזיכרונות שנשמרו בזמן תקלה. 0 = כבוי.
+EMBEDDING_BACKFILL_MINUTES = float(os.getenv("EMBEDDING_BACKFILL_MINUTES", "5"))
+# אסטרטגיית $vectorSearch: auto (exact מתחת לסף המסמכים, אחרת ANN), exact או approx
+VECTOR_SEARCH_STRATEGY = os.getenv("VECTOR_SEARCH_STRATEGY", "auto").lower()
+EXACT_SEARCH_THRESHOLD = int(os.getenv("EXACT_SEARCH_THRESHOLD", "10000"))
+# numCandidates קבוע (0 = אוטומטי: limit * מכפיל, וגדל עם גודל ה-collection)
+NUM_CANDIDATES = int(os.getenv("NUM_CANDIDATES", "0"))
+NUM_CANDIDATES_MULTIPLIER = int(os.getenv("NUM_CANDIDATES_MULTIPLIER", "20"))
+# זיהוי כפילויות בשמירה: ציון דמיון (בסקאלה של Atlas, (1+cos)/2) שמעליו זיכרון
+# נחשב כפול. 0 = רק השוואת hash של התוכן, בלי בדיקה וקטורית (ברירת המחדל:
+# הבדיקה הוקטורית מחכה ל-embedding לפני השמירה, ולכן היא opt-in).
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0"))
+# מצב השיחה (FSM): mongo (משותף לכל ה-workers) או memory (תהליך יחיד / בדיקות)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "mongo").lower()
+# אחרי כמה שעות בלי פעילות מצב שיחה (כולל טיוטה) נמחק
+STATE_TTL_HOURS = float(os.getenv("STATE_TTL_HOURS", "24"))
+# כמה שניות להחזיק מצב שנקרא/נכתב ב-cache מקומי. 0 (ברירת מחדל) = תמיד לקרוא מה-store.
+# רק לתהליך יחיד: cache מקומי לא רואה כתיבות של workers אחרים.
+STATE_CACHE_SECONDS = float(os.getenv("STATE_CACHE_SECONDS", "0"))
+# כמה שניות להחזיק את הסטטיסטיקות של כל משתמש ב-cache (מתבטל גם בכל כתיבה)
+STATS_CACHE_SECONDS = float(os.getenv("STATS_CACHE_SECONDS", "60"))
+# כל כמה דקות לטעון מחדש את אינדקס התגיות מ-tag_counts (שינויים מ-workers אחרים). 0 = כבוי.
+TAG_INDEX_REFRESH_MINUTES = float(os.getenv("TAG_INDEX_REFRESH_MINUTES", "5"))
+
 # Validate required env vars
 required_vars = {
     "BOT_TOKEN": BOT_TOKEN,
     "PUBLIC_URL": PUBLIC_URL,
     "MONGODB_URI": MONGODB_URI,
     "ADMIN_TELEGRAM_ID": ADMIN_TELEGRAM_ID,
-    "OPENAI_API_KEY": OPENAI_API_KEY,
 }
+if EMBEDDING_PROVIDER == "openai":
+    required_vars["OPENAI_API_KEY"] = OPENAI_API_KEY
 missing = [k for k, v in required_vars.items() if not v]
 if missing:
     raise RuntimeError(f"Missing required env vars: {', '.join(missing)}")
+if EMBEDDING_PROVIDER not in EMBEDDING_PROVIDER_DEFAULTS:
+    raise RuntimeError(f"Unknown EMBEDDING_PROVIDER: {EMBEDDING_PROVIDER}")
+if EMBEDDING_PROVIDER == "local" and EMBEDDING_NEXT_FIELD:
+    raise RuntimeError("EMBEDDING_NEXT_FIELD needs a provider with configurable dimensions (openai / hashing)")
+if SEARCH_BACKEND not in ("atlas", "local"):
+    raise RuntimeError(f"Unknown SEARCH_BACKEND: {SEARCH_BACKEND}")
+if SEARCH_MODE not in ("vector", "hybrid"):
+    raise RuntimeError(f"Unknown SEARCH_MODE: {SEARCH_MODE}")
+if VECTOR_SEARCH_STRATEGY not in ("auto", "exact", "approx"):
+    raise RuntimeError(f"Unknown VECTOR_SEARCH_STRATEGY: {VECTOR_SEARCH_STRATEGY}")
+if STATE_BACKEND not in ("mongo", "memory"):
+    raise RuntimeError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+if EMBEDDING_STORAGE not in ("float", "int8", "binary"):
+    raise RuntimeError(f"Unknown EMBEDDING_STORAGE: {EMBEDDING_STORAGE}")
+if bool(EMBEDDING_NEXT_FIELD) != bool(EMBEDDING_NEXT_DIMENSIONS):
+    raise RuntimeError("EMBEDDING_NEXT_FIELD and EMBEDDING_NEXT_DIMENSIONS must be set together")
+if EMBEDDING_NEXT_FIELD == EMBEDDING_FIELD:
+    raise RuntimeError("EMBEDDING_NEXT_FIELD must differ from EMBEDDING_FIELD")
+if np is None and (SEARCH_BACKEND == "local" or EMBEDDING_STORAGE != "float" or EMBEDDING_PROVIDER != "openai"):
+    raise RuntimeError("SEARCH_BACKEND=local, quantized EMBEDDING_STORAGE and local embedding providers require numpy")
 
 # Logging
 logging.basicConfig(
@@ -66,299 +205,3097 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# ==================== OpenAI Embeddings ====================
+# ==================== Metrics ====================
+# מדדי Prometheus לכל שלב בדרך: embedding, פעולות Mongo, חיפוש, handlers ותור ה-webhook.
 
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-EMBEDDING_MODEL = "text-embedding-3-small"
-VECTOR_INDEX_NAME = "memories_vector_index"
-EMBEDDING_DIMENSIONS = 1536  # text-embedding-3-small
+EMBEDDING_LATENCY = Histogram(
+    "memorybot_embedding_request_seconds", "Embeddings request latency (per provider call)"
+)
+EMBEDDING_FAILURES = MetricCounter(
+    "memorybot_embedding_failures_total", "Failed embeddings requests"
+)
+EMBEDDING_RETRIES_TOTAL = MetricCounter(
+    "memorybot_embedding_retries_total", "Retried OpenAI embeddings requests"
+)
+EMBEDDING_CIRCUIT_OPEN = Gauge(
+    "memorybot_embedding_circuit_open", "1 while the embeddings circuit breaker is open"
+)
+EMBEDDING_PENDING_BACKFILLED = MetricCounter(
+    "memorybot_embedding_backfilled_total", "Memories whose embedding was filled in after a failed save"
+)
+EMBEDDING_CACHE_LOOKUPS = MetricCounter(
+    "memorybot_embedding_cache_lookups_total", "Embedding cache lookups", ["result"]
+)
+DOC_CACHE_LOOKUPS = MetricCounter(
+    "memorybot_doc_cache_lookups_total", "Memory document cache lookups", ["result"]
+)
+MONGO_LATENCY = Histogram(
+    "memorybot_mongo_operation_seconds", "MongoDB command latency", ["operation"]
+)
+MONGO_FAILURES = MetricCounter(
+    "memorybot_mongo_failures_total", "Failed MongoDB commands", ["operation"]
+)
+VECTOR_SEARCH_LATENCY = Histogram(
+    "memorybot_vector_search_seconds", "Vector search latency (without the query embedding)", ["backend"]
+)
+SEARCH_FALLBACKS = MetricCounter(
+    "memorybot_search_fallbacks_total", "Vector searches that fell back to keyword search", ["reason"]
+)
+HANDLER_LATENCY = Histogram(
+    "memorybot_handler_seconds", "End-to-end handler latency", ["handler", "route"]
+)
+UPDATE_QUEUE_WAIT = Histogram(
+    "memorybot_update_queue_wait_seconds", "Time an update waited in the webhook queue"
+)
+UPDATE_QUEUE_REJECTED = MetricCounter(
+    "memorybot_update_queue_rejected_total", "Updates rejected because the queue was full"
+)
+UPDATE_QUEUE_DUPLICATES = MetricCounter(
+    "memorybot_update_queue_duplicates_total", "Duplicate updates dropped by update_id"
+)
+UPDATE_QUEUE_DEPTH = Gauge(
+    "memorybot_update_queue_depth", "Updates waiting in the webhook queue"
+)
+STARTUP_SECONDS = Gauge(
+    "memorybot_startup_seconds", "Seconds from process start to each startup phase", ["phase"]
+)
 
 
-def make_embedding(text: str) -> List[float]:
-    """יצירת embedding לטקסט באמצעות OpenAI."""
-    text = (text or "").strip()
-    if not text:
-        return []
+class MongoMetricsListener(monitoring.CommandListener):
+    """מדידת latency לכל פקודת Mongo (find, aggregate, insert, delete...)."""
     
-    try:
-        resp = openai_client.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=text
-        )
-        return resp.data[0].embedding
-    except Exception as e:
-        logger.error(f"Embedding error: {e}")
-        return []
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+    
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+    
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_FAILURES.labels(event.command_name).inc()
 
 
-# ==================== MongoDB ====================
+def timed_handler(handler: str, route_of: Callable[[Update, ContextTypes.DEFAULT_TYPE], str]):
+    """
+    דקורטור: מדידת זמן handler, עם תווית route (מצב FSM / סוג כפתור).
+    ה-route נקבע לפני ה-handler (שמשנה את המצב), ולכן צריך לבוא אחרי with_conversation_state.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            route = route_of(update, context)
+            started = time.perf_counter()
+            try:
+                await func(update, context)
+            finally:
+                HANDLER_LATENCY.labels(handler, route).observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
 
-mongo = MongoClient(MONGODB_URI)
-db = mongo[DB_NAME]
-memories = db["memories"]
 
-# יצירת אינדקסים בסיסיים
-memories.create_index([("created_at", DESCENDING)])
-memories.create_index([("tags", 1)])
+# ==================== OpenAI Embeddings ====================
 
-# ==================== FSM States ====================
+openai_client: Optional[OpenAI] = None  # נוצר בשימוש הראשון
+EMBEDDING_BATCH_SIZE = 100  # טקסטים לבקשת embeddings אחת
+EMBEDDING_BACKOFF_BASE = 0.5  # שניות, לפני ה-jitter
+EMBEDDING_BACKOFF_MAX = 4.0
+RETRYABLE_EMBEDDING_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
 
-MODE_KEY = "mode"
-DRAFT_KEY = "draft"
-LAST_RESULTS_KEY = "last_results"
 
-# States
-MODE_NONE = "none"
-MODE_SAVE_WAIT_TEXT = "save_wait_text"
-MODE_SAVE_WAIT_TITLE = "save_wait_title"
-MODE_SAVE_WAIT_TAGS = "save_wait_tags"
-MODE_SAVE_CONFIRM = "save_confirm"
-MODE_QUERY_WAIT_TEXT = "query_wait_text"
-MODE_TAG_SEARCH_WAIT = "tag_search_wait"
-MODE_DELETE_CONFIRM = "delete_confirm"
+def get_openai_client() -> OpenAI:
+    """ה-client של OpenAI (נוצר בקריאה הראשונה). ה-retries שלנו, לא של ה-SDK."""
+    global openai_client
+    if openai_client is None:
+        openai_client = OpenAI(api_key=OPENAI_API_KEY, timeout=EMBEDDING_TIMEOUT, max_retries=0)
+    return openai_client
 
-# ==================== UI Components ====================
 
-MAIN_KEYBOARD = ReplyKeyboardMarkup(
-    [
-        [KeyboardButton("➕ שמור פתרון"), KeyboardButton("🔎 שאל את הזיכרון")],
-        [KeyboardButton("📚 רשימת זיכרונות"), KeyboardButton("🏷️ חיפוש לפי תגית")],
-        [KeyboardButton("📊 סטטיסטיקות"), KeyboardButton("❓ עזרה")],
-    ],
-    resize_keyboard=True
-)
+class EmbeddingUnavailable(Exception):
+    """ה-circuit breaker פתוח - לא פונים ל-OpenAI."""
 
-CANCEL_KEYBOARD = ReplyKeyboardMarkup(
-    [[KeyboardButton("❌ ביטול")]],
-    resize_keyboard=True
-)
+
+class CircuitBreaker:
+    """
+    אחרי threshold כשלונות רצופים נפתח ל-cooldown שניות, ובזמן הזה קריאות נכשלות מיד.
+    אחרי ה-cooldown קריאה אחת עוברת לבדיקה (half-open): הצלחה סוגרת, כשלון פותח שוב.
+    """
+    
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    def is_open(self) -> bool:
+        """האם קריאות נחסמות כרגע (בלי לתפוס את קריאת הבדיקה)."""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            return self._probing or time.monotonic() - self._opened_at < self.cooldown
+    
+    def allow(self) -> bool:
+        """האם מותר לקרוא עכשיו. ב-half-open רק קריאה אחת מקבלת True."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+    
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Embeddings circuit closed")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+            EMBEDDING_CIRCUIT_OPEN.set(0)
+    
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warning(f"Embeddings circuit open for {self.cooldown:.0f}s")
+                self._opened_at = time.monotonic()
+                self._probing = False
+                EMBEDDING_CIRCUIT_OPEN.set(1)
+    
+    def release_probe(self) -> None:
+        """קריאת הבדיקה הסתיימה בלי הצלחה ובלי תקלה זמנית: הקריאה הבאה תבדוק שוב."""
+        with self._lock:
+            self._probing = False
 
 
-def get_confirm_keyboard(memory_id: str = "") -> InlineKeyboardMarkup:
-    """כפתורי אישור לשמירת זיכרון."""
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ שמור", callback_data=f"confirm_save:{memory_id}"),
-            InlineKeyboardButton("❌ בטל", callback_data="cancel_save"),
-        ],
-        [
-            InlineKeyboardButton("✏️ ערוך כותרת", callback_data="edit_title"),
-            InlineKeyboardButton("✏️ ערוך תגיות", callback_data="edit_tags"),
-        ]
-    ])
+embedding_breaker = CircuitBreaker(EMBEDDING_BREAKER_THRESHOLD, EMBEDDING_BREAKER_COOLDOWN)
 
 
-def get_memory_actions_keyboard(memory_id: str) -> InlineKeyboardMarkup:
-    """כפתורי פעולות על זיכרון."""
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("📖 הצג מלא", callback_data=f"view_full:{memory_id}"),
-            InlineKeyboardButton("🗑️ מחק", callback_data=f"delete:{memory_id}"),
-        ]
-    ])
+def request_embeddings(params: Dict[str, Any]) -> Any:
+    """
+    קריאה ל-OpenAI עם timeout קשיח, ניסיונות חוזרים (backoff אקספוננציאלי עם full jitter)
+    לשגיאות זמניות בלבד, ודרך ה-circuit breaker.
+    """
+    for attempt in range(EMBEDDING_RETRIES + 1):
+        if not embedding_breaker.allow():
+            raise EmbeddingUnavailable("embeddings circuit is open")
+        try:
+            with EMBEDDING_LATENCY.time():
+                resp = get_openai_client().embeddings.create(**params)
+        except RETRYABLE_EMBEDDING_ERRORS as e:
+            embedding_breaker.record_failure()
+            if attempt == EMBEDDING_RETRIES:
+                raise
+            delay = random.uniform(0, min(EMBEDDING_BACKOFF_MAX, EMBEDDING_BACKOFF_BASE * 2 ** attempt))
+            logger.warning(f"Embedding request failed ({e}), retrying in {delay:.2f}s")
+            EMBEDDING_RETRIES_TOTAL.inc()
+            time.sleep(delay)
+            continue
+        except BaseException:
+            # שגיאה שאינה תקלה זמנית (BadRequest, Authentication...) לא פותחת את ה-breaker,
+            # אבל אסור שתשאיר אותו תקוע ב-half-open
+            embedding_breaker.release_probe()
+            raise
+        embedding_breaker.record_success()
+        return resp
 
 
-# ==================== Helper Functions ====================
+def model_supports_dimensions(model: str) -> bool:
+    """רק מודלי text-embedding-3 מקבלים את הפרמטר dimensions."""
+    return model.startswith("text-embedding-3")
 
-def is_admin(update: Update) -> bool:
-    """בדיקה האם המשתמש הוא ה-admin."""
-    user_id = update.effective_user.id if update.effective_user else 0
-    return user_id == ADMIN_TELEGRAM_ID
 
+# ==================== Embedding Providers ====================
+# make_embeddings לא יודע מי מייצר את הוקטורים: ספק מקבל קבוצת טקסטים ומחזיר
+# וקטור לכל אחד, או זורק חריגה לכל הקבוצה. ה-cache, ה-dedup והחלוקה לקבוצות
+# נשארים ב-make_embeddings. timeouts / retries / circuit breaker רלוונטיים רק לרשת.
 
-def split_tags(s: str) -> List[str]:
-    """פירוק מחרוזת תגיות לרשימה."""
-    parts = [p.strip().lower() for p in s.replace("#", "").split(",")]
-    return [p for p in parts if p]
+class EmbeddingProvider(ABC):
+    """ממשק לספק embeddings."""
+    
+    name = ""
+    cacheable = True  # האם לשמור ב-embedding cache (LRU + MongoDB)
+    
+    def __init__(self, model: str):
+        self.model = model
+    
+    @abstractmethod
+    def embed(self, texts: List[str], dimensions: int) -> List[List[float]]:
+        """וקטור לכל טקסט (טקסטים מנורמלים ולא ריקים), באותו סדר."""
+    
+    def warm_up(self) -> None:
+        """הכנה מראש (client / טעינת מודל), כדי שהבקשה הראשונה לא תשלם עליה."""
+    
+    def close(self) -> None:
+        """שחרור משאבים בכיבוי."""
 
 
-def truncate_text(text: str, max_length: int = 200) -> str:
-    """קיצור טקסט עם שלוש נקודות."""
-    if len(text) <= max_length:
-        return text
-    return text[:max_length] + "…"
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """OpenAI embeddings API, דרך request_embeddings (timeout, retries, circuit breaker)."""
+    
+    name = "openai"
+    
+    def embed(self, texts: List[str], dimensions: int) -> List[List[float]]:
+        params: Dict[str, Any] = {"model": self.model, "input": texts}
+        if model_supports_dimensions(self.model):
+            params["dimensions"] = dimensions
+        resp = request_embeddings(params)
+        return [item.embedding for item in sorted(resp.data, key=lambda d: d.index)]
+    
+    def warm_up(self) -> None:
+        get_openai_client()
 
 
-def format_memory_preview(doc: Dict[str, Any], index: int = 0) -> str:
-    """פורמט תצוגה מקוצרת של זיכרון."""
-    title = doc.get("title", "(ללא כותרת)")
-    tags = doc.get("tags", [])
-    solution = truncate_text(doc.get("solution", ""), 150)
-    score = doc.get("score", 0)
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """
+    feature hashing של מילים ושל n-grams של תווים: דטרמיניסטי, בלי מודל ובלי רשת.
+    דמיון לקסיקלי בלבד (לא סמנטי) - לבדיקות, benchmarks ועבודה אופליין.
+    """
     
-    tags_str = ", ".join(tags) if tags else "(ללא תגיות)"
-    score_str = f" (התאמה: {score:.0%})" if score else ""
+    name = "hashing"
+    cacheable = False  # החישוב זול יותר מקריאה ל-cache
+    NGRAM = 3
     
-    return f"**{index}) {title}**{score_str}\n🏷️ {tags_str}\n📝 {solution}\n"
+    def features(self, text: str) -> List[str]:
+        words = re.findall(r"\w+", text.lower())
+        grams = []
+        for word in words:
+            padded = f"#{word}#"
+            grams.extend(padded[i:i + self.NGRAM] for i in range(max(1, len(padded) - self.NGRAM + 1)))
+        return words + grams or [text]
+    
+    def embed(self, texts: List[str], dimensions: int) -> List[List[float]]:
+        with EMBEDDING_LATENCY.time():
+            matrix = np.zeros((len(texts), dimensions), dtype=np.float32)
+            for row, text in enumerate(texts):
+                for feature in self.features(text):
+                    h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                    # הביט העליון קובע סימן, כדי שהתנגשויות יתקזזו בממוצע
+                    matrix[row, h % dimensions] += 1.0 if h >> 63 else -1.0
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix /= np.where(norms == 0, 1.0, norms)
+        return matrix.tolist()
 
 
-def format_memory_full(doc: Dict[str, Any]) -> str:
-    """פורמט תצוגה מלאה של זיכרון."""
-    title = doc.get("title", "(ללא כותרת)")
-    tags = doc.get("tags", [])
-    solution = doc.get("solution", "")
-    code = doc.get("code", "")
-    created = doc.get("created_at")
+class SentenceTransformerEmbeddingProvider(EmbeddingProvider):
+    """מודל sentence-transformers מקומי על CPU (נטען בשימוש הראשון). המימדים קבועים למודל."""
     
-    tags_str = ", ".join(tags) if tags else "(ללא תגיות)"
-    date_str = created.strftime("%Y-%m-%d %H:%M") if created else ""
+    name = "local"
     
-    text = f"📌 **{title}**\n\n"
-    text += f"🏷️ תגיות: {tags_str}\n"
-    text += f"📅 נוצר: {date_str}\n\n"
-    text += f"📝 **פתרון:**\n{solution}\n"
+    def __init__(self, model: str):
+        super().__init__(model)
+        self._model: Any = None
+        self._lock = threading.Lock()
     
-    if code:
-        text += f"\n💻 **קוד:**\n```\n{code}\n```"
+    def _load(self) -> Any:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError:
+                        raise RuntimeError("EMBEDDING_PROVIDER=local requires sentence-transformers")
+                    self._model = SentenceTransformer(self.model, device="cpu")
+                    logger.info(f"Loaded local embedding model {self.model} "
+                                f"({self._model.get_sentence_embedding_dimension()} dimensions)")
+        return self._model
     
-    return text
+    def embed(self, texts: List[str], dimensions: int) -> List[List[float]]:
+        model = self._load()
+        native = model.get_sentence_embedding_dimension()
+        if dimensions != native:
+            raise ValueError(f"{self.model} produces {native} dimensions, not {dimensions}")
+        with EMBEDDING_LATENCY.time():
+            vectors = model.encode(texts, normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.astype(np.float32).tolist()
+    
+    def warm_up(self) -> None:
+        self._load()
 
 
-def reset_user_state(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """איפוס מצב המשתמש."""
-    context.user_data[MODE_KEY] = MODE_NONE
-    context.user_data.pop(DRAFT_KEY, None)
-    context.user_data.pop(LAST_RESULTS_KEY, None)
+_worker_provider: Optional[EmbeddingProvider] = None  # בתוך תהליך של ProcessPoolEmbeddingProvider
 
 
-# ==================== Database Operations ====================
+def _embed_in_worker(texts: List[str], dimensions: int) -> List[List[float]]:
+    """רץ בתהליך ה-worker: הספק (והמודל) נבנה פעם אחת לכל תהליך."""
+    global _worker_provider
+    if _worker_provider is None:
+        _worker_provider = EMBEDDING_PROVIDERS[EMBEDDING_PROVIDER](EMBEDDING_MODEL)
+    return _worker_provider.embed(texts, dimensions)
 
-def save_memory(doc: Dict[str, Any]) -> str:
-    """שמירת זיכרון חדש עם embedding."""
-    # יצירת embedding לחיפוש סמנטי
-    to_embed = f"""
-Title: {doc.get('title', '')}
-Tags: {', '.join(doc.get('tags', []))}
-Solution: {doc.get('solution', '')}
-Context: {doc.get('context', '')}
-    """.strip()
+
+class ProcessPoolEmbeddingProvider(EmbeddingProvider):
+    """
+    עוטף ספק מקומי ומחלק כל קבוצה בין EMBEDDING_WORKERS תהליכים, כך שחישוב כבד
+    על CPU לא נלחם ב-GIL עם ה-event loop וה-thread pool.
+    """
     
-    doc["embedding"] = make_embedding(to_embed)
-    doc["created_at"] = datetime.utcnow()
-    doc["updated_at"] = datetime.utcnow()
+    def __init__(self, inner: EmbeddingProvider, workers: int):
+        super().__init__(inner.model)
+        self.name = inner.name
+        self.cacheable = inner.cacheable
+        self.workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
     
-    result = memories.insert_one(doc)
-    return str(result.inserted_id)
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    # spawn ולא fork: התהליך הראשי מחזיק threads ו-locks (Mongo, thread pool)
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                    )
+        return self._pool
+    
+    def embed(self, texts: List[str], dimensions: int) -> List[List[float]]:
+        size = max(1, math.ceil(len(texts) / self.workers))
+        chunks = [texts[i:i + size] for i in range(0, len(texts), size)]
+        results: List[List[float]] = []
+        with EMBEDDING_LATENCY.time():
+            for part in self._get_pool().map(_embed_in_worker, chunks, [dimensions] * len(chunks)):
+                results.extend(part)
+        return results
+    
+    def warm_up(self) -> None:
+        # טקסט אחד לכל worker - מעלה את התהליכים וטוען בהם את המודל
+        list(self._get_pool().map(_embed_in_worker, [["warm up"]] * self.workers,
+                                  [EMBEDDING_DIMENSIONS] * self.workers))
+    
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+EMBEDDING_PROVIDERS: Dict[str, Callable[[str], EmbeddingProvider]] = {
+    "openai": OpenAIEmbeddingProvider,
+    "local": SentenceTransformerEmbeddingProvider,
+    "hashing": HashingEmbeddingProvider,
+}
+
+
+def build_embedding_provider() -> EmbeddingProvider:
+    """הספק לפי EMBEDDING_PROVIDER (בתהליכים נפרדים אם EMBEDDING_WORKERS > 0)."""
+    provider = EMBEDDING_PROVIDERS[EMBEDDING_PROVIDER](EMBEDDING_MODEL)
+    if EMBEDDING_WORKERS > 0 and EMBEDDING_PROVIDER != "openai":
+        return ProcessPoolEmbeddingProvider(provider, EMBEDDING_WORKERS)
+    return provider
+
+
+embedding_provider = build_embedding_provider()
+
+
+def embed_isolating_failures(provider: "EmbeddingProvider", texts: List[str],
+                             dimensions: int) -> List[List[float]]:
+    """
+    קבוצה שנכשלה בשגיאה קבועה (למשל טקסט אחד מעל מגבלת הטוקנים של המודל):
+    חלוקה לחצאים עד שרק הטקסטים הבעייתיים מקבלים רשימה ריקה, ושאר הקבוצה נשמרת.
+    """
+    if len(texts) <= 1:
+        return [[] for _ in texts]
+    mid = len(texts) // 2
+    results: List[List[float]] = []
+    for part in (texts[:mid], texts[mid:]):
+        try:
+            results.extend(provider.embed(part, dimensions))
+        except (EmbeddingUnavailable, *RETRYABLE_EMBEDDING_ERRORS):
+            # תקלה זמנית - לא מפרקים הלאה, ינוסה שוב בהרצה הבאה
+            results.extend([] for _ in part)
+        except Exception:
+            results.extend(embed_isolating_failures(provider, part, dimensions))
+    return results
+
+
+def make_embedding(text: str, dimensions: Optional[int] = None) -> List[float]:
+    """יצירת embedding לטקסט דרך ספק ה-embeddings (וה-cache)."""
+    return make_embeddings([text], dimensions)[0]
+
+
+def make_embeddings(texts: List[str], dimensions: Optional[int] = None) -> List[List[float]]:
+    """
+    יצירת embeddings לרשימת טקסטים (ברירת מחדל: EMBEDDING_DIMENSIONS מימדים).
+    טקסטים שאינם ב-cache נשלחים לספק בקבוצות של EMBEDDING_BATCH_SIZE.
+    טקסט שנכשל או ריק מקבל רשימה ריקה.
+    """
+    dimensions = dimensions or EMBEDDING_DIMENSIONS
+    provider = embedding_provider
+    normalized = [normalize_embedding_text(t) for t in texts]
+    results: List[List[float]] = [[] for _ in texts]
+    
+    # מיפוי מפתח cache -> אינדקסים (טקסטים זהים נשלחים פעם אחת)
+    pending: Dict[str, List[int]] = {}
+    for i, text in enumerate(normalized):
+        if text:
+            pending.setdefault(embedding_cache_key(text, dimensions), []).append(i)
+    
+    if provider.cacheable:
+        for key, embedding in embedding_cache_get_many(list(pending)).items():
+            for i in pending.pop(key):
+                results[i] = embedding
+    
+    keys = list(pending)
+    computed: Dict[str, List[float]] = {}
+    for start in range(0, len(keys), EMBEDDING_BATCH_SIZE):
+        batch_keys = keys[start:start + EMBEDDING_BATCH_SIZE]
+        batch_texts = [normalized[pending[k][0]] for k in batch_keys]
+        try:
+            embeddings = provider.embed(batch_texts, dimensions)
+        except EmbeddingUnavailable:
+            # ה-breaker פתוח - גם שאר הקבוצות ייכשלו, לא מחכים
+            EMBEDDING_FAILURES.inc()
+            break
+        except RETRYABLE_EMBEDDING_ERRORS as e:
+            EMBEDDING_FAILURES.inc()
+            logger.error(f"Embedding error: {e}")
+            continue
+        except Exception as e:
+            # שגיאה קבועה: כנראה טקסט אחד פגום - לא מפילים בגללו את כל הקבוצה
+            EMBEDDING_FAILURES.inc()
+            logger.error(f"Embedding error, isolating the failing texts: {e}")
+            embeddings = embed_isolating_failures(provider, batch_texts, dimensions)
+        
+        for key, embedding in zip(batch_keys, embeddings):
+            if embedding:
+                computed[key] = embedding
+            for i in pending[key]:
+                results[i] = embedding
+    
+    if provider.cacheable and computed:
+        embedding_cache_put_many(computed)
+    return results
+
+
+# ==================== MongoDB ====================
+
+# החיבור נוצר בשימוש הראשון ולא בזמן import: MongoClient עם mongodb+srv
+# מבצע DNS lookup כבר בבנייה, וזה מאט את ה-cold start לפני שה-webhook עונה.
+_mongo: Optional[MongoClient] = None
+_mongo_lock = threading.Lock()
+
+
+def get_mongo() -> MongoClient:
+    """ה-MongoClient המשותף (נוצר בקריאה הראשונה)."""
+    global _mongo
+    if _mongo is None:
+        with _mongo_lock:
+            if _mongo is None:
+                _mongo = MongoClient(MONGODB_URI, event_listeners=[MongoMetricsListener()])
+    return _mongo
+
+
+def get_db():
+    """מסד הנתונים של הבוט."""
+    return get_mongo()[DB_NAME]
+
+
+def ping_mongo() -> None:
+    """בדיקה ש-MongoDB עונה (גם מחמם את ה-connection pool)."""
+    get_db().command("ping")
+
+
+class LazyCollection:
+    """collection שמתחבר ל-Mongo רק בגישה הראשונה לאחת הפעולות שלו."""
+    
+    def __init__(self, name: str):
+        self.name = name
+    
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(get_db()[self.name], attr)
+
+
+memories = LazyCollection("memories")
+embedding_cache = LazyCollection("embedding_cache")
+tag_counts = LazyCollection("tag_counts")  # ספירת תגיות מתוחזקת: {owner_id, tag, count}
+jobs = LazyCollection("jobs")  # checkpoints של משימות רקע
+conversation_state = LazyCollection("conversation_state")  # מצב FSM לכל משתמש
+
+
+def ensure_indexes() -> None:
+    """
+    יצירת האינדקסים (אידמפוטנטי).
+    רץ ברקע אחרי עליית השרת, או פעם אחת דרך `python main.py migrate`.
+    """
+    # כל אינדקס מתחיל ב-owner_id: שאילתה של משתמש סורקת רק את הטווח שלו
+    # (owner_id, created_at, _id) - סדר יציב ל-keyset pagination
+    memories.create_index([("owner_id", 1), ("created_at", DESCENDING), ("_id", DESCENDING)])
+    memories.create_index([("owner_id", 1), ("tags", 1), ("created_at", DESCENDING), ("_id", DESCENDING)])
+    # אינדקס הטקסט הישן (בלי owner_id) - יש רק אחד לכל collection
+    drop_index_if_exists(memories, "memories_text_index")
+    memories.create_index(
+        [("owner_id", 1), ("title", TEXT), ("tags", TEXT), ("solution", TEXT)],
+        name="memories_owner_text_index",
+        weights={"title": 5, "tags": 3, "solution": 1},
+        default_language="none"  # בלי stemming - התוכן מעורב עברית/אנגלית
+    )
+    memories.create_index(
+        [("owner_id", 1), ("import_key", 1)],
+        unique=True,
+        partialFilterExpression={"import_key": {"$exists": True}}
+    )
+    memories.create_index([("owner_id", 1), ("content_hash", 1)])
+    memories.create_index(
+        [("embedding_status", 1), ("embedding_retry_at", 1)],
+        partialFilterExpression={"embedding_status": {"$exists": True}}
+    )
+    # ה-refresh של האינדקס המקומי (לכל המשתמשים): embeddings שנכתבו מאז ה-watermark
+    memories.create_index([("embedded_at", 1)])
+    tag_counts.create_index([("owner_id", 1), ("tag", 1)], unique=True)
+    tag_counts.create_index([("owner_id", 1), ("count", DESCENDING)])
+    embedding_cache.create_index(
+        [("created_at", 1)],
+        expireAfterSeconds=EMBEDDING_CACHE_TTL_DAYS * 24 * 3600
+    )
+    conversation_state.create_index([("expires_at", 1)], expireAfterSeconds=0)
+    # אינדקסים מלפני החלוקה למשתמשים - מיותרים מול הגרסאות עם owner_id
+    for name in LEGACY_INDEXES:
+        drop_index_if_exists(memories, name)
+    drop_index_if_exists(tag_counts, "count_-1")
+
+
+# אינדקסים של memories מלפני owner_id
+LEGACY_INDEXES = ["created_at_-1__id_-1", "tags_1_created_at_-1__id_-1", "import_key_1", "content_hash_1"]
+
+
+def drop_index_if_exists(collection: Any, name: str) -> None:
+    """מחיקת אינדקס לפי שם, אם הוא קיים."""
+    if name in collection.index_information():
+        collection.drop_index(name)
+        logger.info(f"Dropped legacy index {collection.name}.{name}")
+
+# ==================== Embedding Cache ====================
+# שתי שכבות: LRU בזיכרון התהליך, ומתחתיו collection ב-MongoDB עם TTL.
+# המפתח הוא hash של שם המודל + הטקסט המנורמל.
+
+_embedding_lru: "OrderedDict[str, List[float]]" = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+embedding_cache_stats = {"lru_hits": 0, "mongo_hits": 0, "misses": 0}
+
+
+def normalize_embedding_text(text: str) -> str:
+    """נרמול טקסט ל-embedding: הסרת רווחים מיותרים ושורות ריקות."""
+    lines = (" ".join(line.split()) for line in (text or "").splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def embedding_cache_key(text: str, dimensions: int) -> str:
+    """מפתח cache: sha256 של המודל, מספר המימדים והטקסט המנורמל."""
+    return hashlib.sha256(f"{EMBEDDING_MODEL}:{dimensions}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _lru_put(key: str, embedding: List[float]) -> None:
+    with _embedding_cache_lock:
+        _embedding_lru[key] = embedding
+        _embedding_lru.move_to_end(key)
+        while len(_embedding_lru) > EMBEDDING_CACHE_SIZE:
+            _embedding_lru.popitem(last=False)
+
+
+def _count_cache(stat: str, n: int = 1) -> None:
+    if not n:
+        return
+    with _embedding_cache_lock:
+        embedding_cache_stats[stat] += n
+    EMBEDDING_CACHE_LOOKUPS.labels(stat).inc(n)
+
+
+def embedding_cache_get_many(keys: List[str]) -> Dict[str, List[float]]:
+    """חיפוש embeddings ב-cache (LRU ואז find אחד ב-MongoDB). מחזיר רק את מה שנמצא."""
+    found: Dict[str, List[float]] = {}
+    with _embedding_cache_lock:
+        for key in keys:
+            embedding = _embedding_lru.get(key)
+            if embedding is not None:
+                _embedding_lru.move_to_end(key)
+                found[key] = embedding
+    _count_cache("lru_hits", len(found))
+    
+    missing = [k for k in keys if k not in found]
+    from_mongo = 0
+    if missing:
+        try:
+            for doc in embedding_cache.find({"_id": {"$in": missing}}, {"embedding": 1}):
+                if doc.get("embedding"):
+                    found[doc["_id"]] = doc["embedding"]
+                    _lru_put(doc["_id"], doc["embedding"])
+                    from_mongo += 1
+        except Exception as e:
+            logger.warning(f"Embedding cache read error: {e}")
+    _count_cache("mongo_hits", from_mongo)
+    _count_cache("misses", len(missing) - from_mongo)
+    return found
+
+
+def embedding_cache_put_many(embeddings: Dict[str, List[float]]) -> None:
+    """שמירת embeddings בשתי שכבות ה-cache (bulk_write אחד של upserts)."""
+    now = datetime.utcnow()
+    for key, embedding in embeddings.items():
+        _lru_put(key, embedding)
+    try:
+        embedding_cache.bulk_write([
+            UpdateOne(
+                {"_id": key},
+                {"$setOnInsert": {"model": EMBEDDING_MODEL, "embedding": embedding, "created_at": now}},
+                upsert=True
+            )
+            for key, embedding in embeddings.items()
+        ], ordered=False)
+    except Exception as e:
+        logger.warning(f"Embedding cache write error: {e}")
+
+
+def get_embedding_cache_stats() -> Dict[str, Any]:
+    """מוני hit/miss של ה-cache."""
+    with _embedding_cache_lock:
+        stats = dict(embedding_cache_stats)
+        stats["lru_size"] = len(_embedding_lru)
+    lookups = stats["lru_hits"] + stats["mongo_hits"] + stats["misses"]
+    hits = stats["lru_hits"] + stats["mongo_hits"]
+    stats["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+    return stats
+
+# ==================== Embedding Storage ====================
+# במצב float ה-embedding נשמר כמערך doubles (כמו תמיד).
+# במצבי int8 / binary נשמרים שני שדות כ-BSON binary vectors:
+#   <field>   - float32 בדיוק מלא (חצי מגודל ה-doubles), לדירוג מחדש
+#   <field>_q - הוקטור המכומת, שעליו בנוי אינדקס ה-Atlas (פי 4 / 32 קטן יותר)
+
+
+def quantized_field(field: str = EMBEDDING_FIELD) -> str:
+    """שם השדה של הוקטור המכומת."""
+    return f"{field}_q"
+
+
+def storage_field(field: str = EMBEDDING_FIELD) -> str:
+    """שם השדה שמסמן את שיטת האחסון של וקטור מכומת."""
+    return f"{field}_storage"
+
+
+def quantize_embedding(embedding: List[float], storage: str) -> Binary:
+    """כימות embedding ל-int8 (סקאלה לפי הערך המקסימלי) או לביטים (סימן)."""
+    vec = np.asarray(embedding, dtype=np.float32)
+    if storage == "int8":
+        peak = float(np.abs(vec).max()) or 1.0
+        q = np.clip(np.rint(vec / peak * 127), -127, 127).astype(np.int8)
+        return Binary.from_vector(q.tolist(), BinaryVectorDtype.INT8)
+    packed = np.packbits(vec > 0)
+    return Binary.from_vector(packed.tolist(), BinaryVectorDtype.PACKED_BIT, padding=(-len(vec)) % 8)
+
+
+def encode_embedding(embedding: List[float], storage: str = EMBEDDING_STORAGE,
+                     field: str = EMBEDDING_FIELD) -> Dict[str, Any]:
+    """שדות ה-embedding לשמירה במסמך, לפי שיטת האחסון."""
+    if storage == "float" or not embedding:
+        return {field: embedding}
+    return {
+        field: Binary.from_vector(embedding, BinaryVectorDtype.FLOAT32),
+        quantized_field(field): quantize_embedding(embedding, storage),
+        storage_field(field): storage,
+    }
+
+
+def decode_embedding(value: Any) -> List[float]:
+    """קריאת embedding שמור (מערך או BSON float32 vector) לרשימת floats."""
+    if isinstance(value, Binary):
+        return list(value.as_vector().data)
+    return value or []
+
+
+def has_embedding(field: str = EMBEDDING_FIELD) -> Dict[str, Any]:
+    """סינון למסמכים שיש להם embedding בשדה הנתון."""
+    return {field: {"$exists": True, "$ne": []}}
+
+
+def vector_index_name(base_name: str = VECTOR_INDEX_NAME, storage: str = EMBEDDING_STORAGE) -> str:
+    """שם אינדקס ה-Atlas לפי שיטת האחסון."""
+    return base_name if storage == "float" else f"{base_name}_{storage}"
+
+
+def build_vector_index_definition(field: str = EMBEDDING_FIELD,
+                                  dimensions: int = EMBEDDING_DIMENSIONS,
+                                  storage: str = EMBEDDING_STORAGE) -> Dict[str, Any]:
+    """הגדרת אינדקס Atlas Vector Search שתואמת לשדה, למימדים ולשיטת האחסון."""
+    return {
+        "fields": [
+            {
+                "type": "vector",
+                "path": field if storage == "float" else quantized_field(field),
+                "numDimensions": dimensions,
+                # וקטורי ביטים (int1) נתמכים ב-Atlas רק עם euclidean (hamming)
+                "similarity": "euclidean" if storage == "binary" else "cosine"
+            },
+            {"type": "filter", "path": "owner_id"},
+            {"type": "filter", "path": "tags"},
+            {"type": "filter", "path": "created_at"},
+        ]
+    }
+
+
+# ==================== Local Vector Index ====================
+# חלופה ל-Atlas $vectorSearch (Mongo self-hosted / פיתוח מקומי).
+# מטריצת float32 רציפה של embeddings מנורמלים + מיפוי _id -> שורה,
+# ולצידה מערך owner_id לכל שורה, כך שהסינון למשתמש הוא מסכה ב-numpy.
+# החיפוש מדויק (מכפלת מטריצה בוקטור), והעדכון אינקרמנטלי: כתיבות של התהליך עצמו
+# מיד, ושל תהליכים אחרים (workers, reembed מה-CLI) ב-refresh לפי embedded_at.
+
+class LocalVectorIndex:
+    """אינדקס וקטורי מקומי עם top-k מדויק."""
+    
+    NO_OWNER = -1  # מסמך בלי owner_id
+    # חפיפה אחורה ב-refresh: כתיבה שה-embedded_at שלה נקבע לפני ה-watermark אבל הגיעה ל-Mongo אחריו
+    SYNC_OVERLAP = timedelta(minutes=5)
+    
+    def __init__(self, dimensions: int, path: str = ""):
+        self.dimensions = dimensions
+        self.path = path
+        self._lock = threading.RLock()
+        self._matrix = np.zeros((0, dimensions), dtype=np.float32)
+        self._owners = np.zeros(0, dtype=np.int64)
+        self._size = 0
+        self._ids: List[ObjectId] = []
+        self._rows: Dict[ObjectId, int] = {}
+        self._synced_at: Optional[datetime] = None  # ה-watermark: עד מתי נמשכו embeddings
+    
+    def __len__(self) -> int:
+        return self._size
+    
+    def _normalize(self, embedding: List[float]) -> Optional["np.ndarray"]:
+        vec = np.asarray(embedding, dtype=np.float32)
+        if vec.shape != (self.dimensions,):
+            return None
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else None
+    
+    def _ensure_capacity(self, rows: int) -> None:
+        capacity = self._matrix.shape[0]
+        if rows <= capacity:
+            return
+        grown = np.zeros((max(rows, capacity * 2, 1024), self.dimensions), dtype=np.float32)
+        grown[:self._size] = self._matrix[:self._size]
+        self._matrix = grown
+        owners = np.full(grown.shape[0], self.NO_OWNER, dtype=np.int64)
+        owners[:self._size] = self._owners[:self._size]
+        self._owners = owners
+    
+    def add(self, doc_id: ObjectId, embedding: List[float], owner_id: Optional[int] = None) -> None:
+        """הוספה או עדכון של וקטור (עם המשתמש שהוא שייך לו)."""
+        vec = self._normalize(embedding)
+        if vec is None:
+            return
+        with self._lock:
+            row = self._rows.get(doc_id)
+            if row is None:
+                self._ensure_capacity(self._size + 1)
+                row = self._size
+                self._size += 1
+                self._ids.append(doc_id)
+                self._rows[doc_id] = row
+            self._matrix[row] = vec
+            self._owners[row] = self.NO_OWNER if owner_id is None else owner_id
+    
+    def remove(self, doc_id: ObjectId) -> None:
+        """הסרת וקטור: השורה האחרונה עוברת למקום שהתפנה."""
+        with self._lock:
+            row = self._rows.pop(doc_id, None)
+            if row is None:
+                return
+            last = self._size - 1
+            if row != last:
+                moved_id = self._ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._owners[row] = self._owners[last]
+                self._ids[row] = moved_id
+                self._rows[moved_id] = row
+            self._ids.pop()
+            self._size -= 1
+    
+    def search(self, embedding: List[float], k: int,
+               allowed: Optional[Iterable[ObjectId]] = None,
+               owner_id: Optional[int] = None) -> List[Tuple[ObjectId, float]]:
+        """
+        top-k לפי cosine. הציון בסקאלה של Atlas: (1 + cos) / 2.
+        allowed - אם ניתן, החיפוש רק על ה-ids האלה (pre-filter).
+        owner_id - אם ניתן, רק שורות של המשתמש (מסכה על מערך ה-owners).
+        """
+        q = self._normalize(embedding)
+        if q is None or k <= 0:
+            return []
+        with self._lock:
+            if allowed is None:
+                rows = np.arange(self._size)
+            else:
+                rows = np.fromiter(
+                    (r for r in (self._rows.get(i) for i in allowed) if r is not None), dtype=np.int64
+                )
+            if owner_id is not None:
+                rows = rows[self._owners[rows] == owner_id]
+            if not len(rows):
+                return []
+            scores = self._matrix[rows] @ q
+            if k < len(rows):
+                top = np.argpartition(-scores, k)[:k]
+            else:
+                top = np.arange(len(rows))
+            top = top[np.argsort(-scores[top])]
+            return [(self._ids[rows[i]], (1.0 + float(scores[i])) / 2) for i in top]
+    
+    def load(self, collection) -> None:
+        """טעינה: מהדיסק (memory-mapped) אם יש, ואז סנכרון מול MongoDB."""
+        with self._lock:
+            if self.path and self._load_from_disk():
+                self._sync(collection)
+            else:
+                self._rebuild(collection)
+        logger.info(f"Local vector index loaded: {self._size} vectors")
+    
+    def refresh(self, collection) -> None:
+        """משיכת embeddings שנכתבו מאז ה-watermark (גם בתהליכים אחרים)."""
+        if self._synced_at is None:
+            return
+        started = datetime.utcnow()
+        query = {"embedded_at": {"$gt": self._synced_at - self.SYNC_OVERLAP}}
+        refreshed = 0
+        for doc in collection.find(query, {EMBEDDING_FIELD: 1, "owner_id": 1}):
+            embedding = decode_embedding(doc.get(EMBEDDING_FIELD))
+            if embedding:
+                self.add(doc["_id"], embedding, doc.get("owner_id"))
+                refreshed += 1
+        self._synced_at = started
+        if refreshed:
+            logger.info(f"Local vector index refreshed: {refreshed} vectors")
+    
+    def _rebuild(self, collection) -> None:
+        self._synced_at = datetime.utcnow()
+        self._matrix = np.zeros((0, self.dimensions), dtype=np.float32)
+        self._owners = np.zeros(0, dtype=np.int64)
+        self._size = 0
+        self._ids = []
+        self._rows = {}
+        for doc in collection.find(has_embedding(), {EMBEDDING_FIELD: 1, "owner_id": 1}):
+            self.add(doc["_id"], decode_embedding(doc[EMBEDDING_FIELD]), doc.get("owner_id"))
+    
+    def _sync(self, collection) -> None:
+        """אחרי טעינה מהדיסק: מחיקות והוספות לפי _id, ווקטורים שהשתנו לפי ה-watermark."""
+        db_ids = {d["_id"] for d in collection.find(has_embedding(), {"_id": 1})}
+        for doc_id in set(self._rows) - db_ids:
+            self.remove(doc_id)
+        missing = list(db_ids - set(self._rows))
+        for doc in collection.find({"_id": {"$in": missing}}, {EMBEDDING_FIELD: 1, "owner_id": 1}):
+            self.add(doc["_id"], decode_embedding(doc[EMBEDDING_FIELD]), doc.get("owner_id"))
+        self.refresh(collection)
+    
+    def _files(self) -> Tuple[str, str, str, str]:
+        return (os.path.join(self.path, "vectors.npy"), os.path.join(self.path, "owners.npy"),
+                os.path.join(self.path, "ids.json"), os.path.join(self.path, "meta.json"))
+    
+    def _load_from_disk(self) -> bool:
+        vectors_file, owners_file, ids_file, meta_file = self._files()
+        if not all(os.path.exists(f) for f in (vectors_file, owners_file, ids_file, meta_file)):
+            return False
+        try:
+            # copy-on-write: הקריאה ישירות מהדיסק, שינויים נשארים בזיכרון
+            matrix = np.load(vectors_file, mmap_mode="c")
+            owners = np.load(owners_file)
+            with open(ids_file, "r", encoding="utf-8") as f:
+                ids = [ObjectId(i) for i in json.load(f)]
+            with open(meta_file, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            synced_at = datetime.fromisoformat(meta["synced_at"])
+        except Exception as e:
+            logger.warning(f"Local index load failed, rebuilding: {e}")
+            return False
+        if matrix.shape != (len(ids), self.dimensions) or owners.shape != (len(ids),):
+            return False
+        if (meta.get("model"), meta.get("template")) != (EMBEDDING_MODEL, EMBEDDING_TEMPLATE_VERSION):
+            return False
+        self._synced_at = synced_at
+        self._matrix = matrix
+        self._owners = owners
+        self._size = len(ids)
+        self._ids = ids
+        self._rows = {doc_id: row for row, doc_id in enumerate(ids)}
+        return True
+    
+    def save(self) -> None:
+        """שמירת האינדקס לדיסק (אם הוגדר LOCAL_INDEX_PATH)."""
+        if not self.path:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        vectors_file, owners_file, ids_file, meta_file = self._files()
+        with self._lock:
+            matrix = np.ascontiguousarray(self._matrix[:self._size])
+            owners = self._owners[:self._size].copy()
+            ids = [str(i) for i in self._ids]
+            synced_at = self._synced_at
+        if synced_at is None:
+            return
+        meta = {"synced_at": synced_at.isoformat(), "model": EMBEDDING_MODEL, "template": EMBEDDING_TEMPLATE_VERSION}
+        # קבצים זמניים לכל תהליך - כמה workers יכולים לשמור לאותה תיקייה בכיבוי
+        tmp = f".{os.getpid()}.tmp"
+        np.save(vectors_file + tmp + ".npy", matrix)
+        np.save(owners_file + tmp + ".npy", owners)
+        for path, data in ((ids_file, ids), (meta_file, meta)):
+            with open(path + tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+        # meta אחרון: שמירה שנקטעה באמצע משאירה meta ישן, וה-refresh בעלייה משלים
+        os.replace(vectors_file + tmp + ".npy", vectors_file)
+        os.replace(owners_file + tmp + ".npy", owners_file)
+        os.replace(ids_file + tmp, ids_file)
+        os.replace(meta_file + tmp, meta_file)
+
+
+_local_index: Optional[LocalVectorIndex] = None
+_local_index_lock = threading.Lock()
+
+
+def get_local_index() -> LocalVectorIndex:
+    """האינדקס המקומי, נטען בשימוש הראשון."""
+    global _local_index
+    if _local_index is None:
+        with _local_index_lock:
+            if _local_index is None:
+                index = LocalVectorIndex(EMBEDDING_DIMENSIONS, LOCAL_INDEX_PATH)
+                index.load(memories)
+                _local_index = index
+    return _local_index
+
+
+# ==================== Tag Index ====================
+# העתק בזיכרון של tag_counts: לכל משתמש מערך ממוין של תגיות (חיפוש prefix ב-bisect)
+# ומילון ספירות. נטען בעלייה ומתעדכן ב-update_tag_counts, כך שהצעות התגיות
+# (פופולריות, השלמה, תיקון שגיאות הקלדה) לא פונות ל-Mongo.
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """מרחק עריכה (כולל החלפת שני תווים סמוכים), עם עצירה ברגע שהוא עובר את limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], before[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        before, prev = prev, cur
+    return prev[-1]
+
+
+class TagIndex:
+    """תגיות וספירות לכל משתמש, בזיכרון התהליך."""
+    
+    def __init__(self):
+        self._tags: Dict[int, List[str]] = {}  # owner_id -> תגיות ממוינות
+        self._counts: Dict[int, Dict[str, int]] = {}  # owner_id -> tag -> count
+        self._lock = threading.Lock()
+        self.loaded = False
+    
+    def load(self, collection) -> None:
+        """טעינה מלאה מ-tag_counts (מחליף את התוכן הקיים)."""
+        counts: Dict[int, Dict[str, int]] = {}
+        for doc in collection.find({"count": {"$gt": 0}}, {"_id": 0, "owner_id": 1, "tag": 1, "count": 1}):
+            if doc.get("tag"):
+                counts.setdefault(doc.get("owner_id"), {})[doc["tag"]] = doc["count"]
+        with self._lock:
+            self._counts = counts
+            self._tags = {owner_id: sorted(tags) for owner_id, tags in counts.items()}
+            self.loaded = True
+        logger.info(f"Tag index loaded: {sum(len(t) for t in counts.values())} tags, {len(counts)} users")
+    
+    def apply(self, owner_id: int, counts: Dict[str, int], sign: int = 1) -> None:
+        """עדכון אחרי שמירה / מחיקה (אותו $inc שנשלח ל-tag_counts)."""
+        with self._lock:
+            user_counts = self._counts.setdefault(owner_id, {})
+            user_tags = self._tags.setdefault(owner_id, [])
+            for tag, n in counts.items():
+                count = user_counts.get(tag, 0) + sign * n
+                if count > 0:
+                    if tag not in user_counts:
+                        bisect.insort(user_tags, tag)
+                    user_counts[tag] = count
+                elif tag in user_counts:
+                    del user_counts[tag]
+                    del user_tags[bisect.bisect_left(user_tags, tag)]
+    
+    def has(self, owner_id: int, tag: str) -> bool:
+        with self._lock:
+            return tag in self._counts.get(owner_id, {})
+    
+    def top(self, owner_id: int, limit: int) -> List[Tuple[str, int]]:
+        """התגיות הנפוצות של המשתמש."""
+        with self._lock:
+            counts = self._counts.get(owner_id, {})
+            return heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+    
+    def suggest(self, owner_id: int, term: str, limit: int) -> List[Tuple[str, int]]:
+        """
+        תגיות קרובות ל-term (בלי term עצמו): קודם השלמות (prefix) לפי שכיחות,
+        ואחריהן תגיות במרחק עריכה קטן (1 עד 5 תווים, 2 מעבר לזה).
+        """
+        max_distance = 0 if len(term) <= 2 else 1 if len(term) <= 5 else 2
+        with self._lock:
+            tags = self._tags.get(owner_id, [])
+            counts = self._counts.get(owner_id, {})
+            start = bisect.bisect_left(tags, term)
+            end = bisect.bisect_left(tags, term + "\uffff")
+            completions = heapq.nsmallest(
+                limit, (t for t in tags[start:end] if t != term), key=lambda t: (-counts[t], t)
+            )
+            close: List[Tuple[int, str]] = []
+            if max_distance and len(completions) < limit:
+                for tag in tags:
+                    if tag == term or tag in completions:
+                        continue
+                    distance = edit_distance(term, tag, max_distance)
+                    if distance <= max_distance:
+                        close.append((distance, tag))
+            close.sort(key=lambda item: (item[0], -counts[item[1]], item[1]))
+            ranked = completions + [tag for _, tag in close]
+            return [(tag, counts[tag]) for tag in ranked[:limit]]
+
+
+tag_index = TagIndex()
+
+
+# ==================== FSM States ====================
+
+MODE_KEY = "mode"
+DRAFT_KEY = "draft"
+LAST_RESULTS_KEY = "last_results"
+
+# States
+MODE_NONE = "none"
+MODE_SAVE_WAIT_TEXT = "save_wait_text"
+MODE_SAVE_WAIT_TITLE = "save_wait_title"
+MODE_SAVE_WAIT_TAGS = "save_wait_tags"
+MODE_SAVE_CONFIRM = "save_confirm"
+MODE_QUERY_WAIT_TEXT = "query_wait_text"
+MODE_TAG_SEARCH_WAIT = "tag_search_wait"
+MODE_DELETE_CONFIRM = "delete_confirm"
+
+# ==================== Conversation State ====================
+# מצב השיחה נשמר מחוץ לתהליך כדי שכמה workers (uvicorn --workers N) ו-restart
+# לא יאבדו טיוטות באמצע שמירה. נשמר רק מצב קומפקטי: mode, טיוטה ו-ids של תוצאות.
+
+ConversationState = Dict[str, Any]
+
+
+class StateStore(ABC):
+    """ממשק לאחסון מצב שיחה לפי user_id."""
+    
+    @abstractmethod
+    def load(self, user_id: int) -> ConversationState:
+        """המצב השמור ({} אם אין)."""
+    
+    @abstractmethod
+    def save(self, user_id: int, state: ConversationState) -> None:
+        """שמירת המצב."""
+    
+    @abstractmethod
+    def delete(self, user_id: int) -> None:
+        """מחיקת המצב."""
+
+
+class MemoryStateStore(StateStore):
+    """מצב בזיכרון התהליך (worker יחיד / בדיקות)."""
+    
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._states: Dict[int, Tuple[ConversationState, float]] = {}
+        self._lock = threading.Lock()
+    
+    def load(self, user_id: int) -> ConversationState:
+        with self._lock:
+            entry = self._states.get(user_id)
+            if entry is None:
+                return {}
+            state, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._states[user_id]
+                return {}
+            return json.loads(json.dumps(state))
+    
+    def save(self, user_id: int, state: ConversationState) -> None:
+        with self._lock:
+            self._states[user_id] = (json.loads(json.dumps(state)), time.monotonic() + self.ttl_seconds)
+    
+    def delete(self, user_id: int) -> None:
+        with self._lock:
+            self._states.pop(user_id, None)
+
+
+class MongoStateStore(StateStore):
+    """מצב ב-collection conversation_state, עם TTL על expires_at."""
+    
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+    
+    def load(self, user_id: int) -> ConversationState:
+        doc = conversation_state.find_one({"_id": user_id}, {"state": 1, "expires_at": 1})
+        # מחיקת ה-TTL רצה פעם בדקה - מסננים גם כאן מסמכים שפג תוקפם
+        if not doc or doc["expires_at"] <= datetime.utcnow():
+            return {}
+        return doc.get("state", {})
+    
+    def save(self, user_id: int, state: ConversationState) -> None:
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+        conversation_state.replace_one(
+            {"_id": user_id},
+            {"state": state, "expires_at": expires_at},
+            upsert=True
+        )
+    
+    def delete(self, user_id: int) -> None:
+        conversation_state.delete_one({"_id": user_id})
+
+
+class CachedStateStore(StateStore):
+    """
+    cache מקומי קצר מעל store אחר, write-through: כל כתיבה הולכת ל-store מיד.
+    עם כמה workers, מצב שנכתב ב-worker אחר ייראה כאן רק אחרי ttl_seconds.
+    """
+    
+    def __init__(self, inner: StateStore, ttl_seconds: float):
+        self.inner = inner
+        self.ttl_seconds = ttl_seconds
+        self._cache: Dict[int, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+    
+    def _remember(self, user_id: int, state: ConversationState) -> None:
+        with self._lock:
+            self._cache[user_id] = (json.dumps(state), time.monotonic() + self.ttl_seconds)
+            if len(self._cache) > 10000:
+                now = time.monotonic()
+                self._cache = {k: v for k, v in self._cache.items() if v[1] > now}
+    
+    def load(self, user_id: int) -> ConversationState:
+        with self._lock:
+            entry = self._cache.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            return json.loads(entry[0])
+        state = self.inner.load(user_id)
+        self._remember(user_id, state)
+        return state
+    
+    def save(self, user_id: int, state: ConversationState) -> None:
+        self.inner.save(user_id, state)
+        self._remember(user_id, state)
+    
+    def delete(self, user_id: int) -> None:
+        self.inner.delete(user_id)
+        self._remember(user_id, {})
+
+
+def build_state_store() -> StateStore:
+    """ה-store לפי STATE_BACKEND (עם cache מקומי אם STATE_CACHE_SECONDS > 0)."""
+    ttl_seconds = STATE_TTL_HOURS * 3600
+    if STATE_BACKEND == "memory":
+        return MemoryStateStore(ttl_seconds)
+    store: StateStore = MongoStateStore(ttl_seconds)
+    if STATE_CACHE_SECONDS > 0:
+        store = CachedStateStore(store, STATE_CACHE_SECONDS)
+    return store
+
+
+state_store = build_state_store()
+
+
+def compact_state(state: ConversationState) -> ConversationState:
+    """השמטת ערכי ברירת מחדל - מצב ריק לא נשמר בכלל."""
+    return {
+        k: v for k, v in state.items()
+        if v not in (None, {}, []) and not (k == MODE_KEY and v == MODE_NONE)
+    }
+
+
+def with_conversation_state(func):
+    """דקורטור: טעינת מצב השיחה ל-context.user_data לפני ה-handler ושמירתו אחריו."""
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        if user is None:
+            await func(update, context)
+            return
+        
+        state = await run_blocking(state_store.load, user.id)
+        context.user_data.clear()
+        context.user_data.update(state)
+        before = json.dumps(state, sort_keys=True)
+        try:
+            await func(update, context)
+        finally:
+            state = compact_state(dict(context.user_data))
+            if json.dumps(state, sort_keys=True) != before:
+                if state:
+                    await run_blocking(state_store.save, user.id, state)
+                else:
+                    await run_blocking(state_store.delete, user.id)
+    return wrapper
+
+# ==================== UI Components ====================
+
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton("➕ שמור פתרון"), KeyboardButton("🔎 שאל את הזיכרון")],
+        [KeyboardButton("📚 רשימת זיכרונות"), KeyboardButton("🏷️ חיפוש לפי תגית")],
+        [KeyboardButton("📊 סטטיסטיקות"), KeyboardButton("❓ עזרה")],
+    ],
+    resize_keyboard=True
+)
+
+CANCEL_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("❌ ביטול")]],
+    resize_keyboard=True
+)
+
+
+# תוויות יציבות (ASCII) לכפתורי התפריט, עבור המדדים
+MENU_ROUTES = {
+    "❌ ביטול": "menu_cancel",
+    "➕ שמור פתרון": "menu_save",
+    "🔎 שאל את הזיכרון": "menu_query",
+    "📚 רשימת זיכרונות": "menu_list",
+    "🏷️ חיפוש לפי תגית": "menu_tag_search",
+    "📊 סטטיסטיקות": "menu_stats",
+    "❓ עזרה": "menu_help",
+}
+
+CALLBACK_ROUTES = {
+    "confirm_save", "cancel_save", "edit_title", "edit_tags", "view_full",
+    "delete", "confirm_delete", "cancel_delete", "page",
+    "save_anyway", "dup_merge", "dup_update", "tag",
+}
+
+
+def message_route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """תווית מדדים להודעה: כפתור תפריט או מצב ה-FSM."""
+    text = (update.message.text or "").strip() if update.message else ""
+    return MENU_ROUTES.get(text) or context.user_data.get(MODE_KEY, MODE_NONE)
+
+
+def callback_route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """תווית מדדים ל-callback: הקידומת של callback_data."""
+    prefix = (update.callback_query.data or "").split(":")[0]
+    return prefix if prefix in CALLBACK_ROUTES else "other"
+
+
+def get_confirm_keyboard(memory_id: str = "") -> InlineKeyboardMarkup:
+    """כפתורי אישור לשמירת זיכרון."""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ שמור", callback_data=f"confirm_save:{memory_id}"),
+            InlineKeyboardButton("❌ בטל", callback_data="cancel_save"),
+        ],
+        [
+            InlineKeyboardButton("✏️ ערוך כותרת", callback_data="edit_title"),
+            InlineKeyboardButton("✏️ ערוך תגיות", callback_data="edit_tags"),
+        ]
+    ])
+
+
+def get_duplicate_keyboard() -> InlineKeyboardMarkup:
+    """כפתורים כשהטיוטה כנראה כבר שמורה."""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🔀 מזג לקיים", callback_data="dup_merge"),
+            InlineKeyboardButton("♻️ עדכן את הקיים", callback_data="dup_update"),
+        ],
+        [
+            InlineKeyboardButton("➕ שמור בכל זאת", callback_data="save_anyway"),
+            InlineKeyboardButton("❌ בטל", callback_data="cancel_save"),
+        ]
+    ])
+
+
+TAG_SUGGESTIONS = 6  # כמה תגיות להציע ככפתורים
+
+
+def get_tag_suggestions_keyboard(tags: List[Tuple[str, int]]) -> Optional[InlineKeyboardMarkup]:
+    """כפתורי הצעות תגית (3 בשורה), או None אם אין."""
+    buttons = [
+        InlineKeyboardButton(f"{tag} ({count})", callback_data=f"tag:{tag}")
+        for tag, count in tags
+        if len(f"tag:{tag}".encode("utf-8")) <= CALLBACK_DATA_LIMIT
+    ]
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup([buttons[i:i + 3] for i in range(0, len(buttons), 3)])
+
+
+def get_memory_actions_keyboard(memory_id: str) -> InlineKeyboardMarkup:
+    """כפתורי פעולות על זיכרון."""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("📖 הצג מלא", callback_data=f"view_full:{memory_id}"),
+            InlineKeyboardButton("🗑️ מחק", callback_data=f"delete:{memory_id}"),
+        ]
+    ])
+
+
+# ==================== Helper Functions ====================
+
+def is_admin(update: Update) -> bool:
+    """בדיקה האם המשתמש הוא ה-admin."""
+    user_id = update.effective_user.id if update.effective_user else 0
+    return user_id == ADMIN_TELEGRAM_ID
+
+
+def is_allowed(update: Update) -> bool:
+    """בדיקה האם המשתמש מורשה (ה-admin או ALLOWED_USER_IDS)."""
+    user_id = update.effective_user.id if update.effective_user else 0
+    return user_id == ADMIN_TELEGRAM_ID or user_id in ALLOWED_USER_IDS
+
+
+def owner_of(update: Update) -> int:
+    """בעל הזיכרונות של העדכון (המשתמש ששלח אותו)."""
+    return update.effective_user.id
+
+
+def owner_filter(owner_id: Optional[int],
+                 search_filter: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    סינון ה-$vectorSearch / find למשתמש אחד, בנוסף ל-search_filter.
+    owner_id=None - כל הזיכרונות (כלים ניהוליים כמו eval-recall).
+    """
+    if owner_id is None:
+        return search_filter or {}
+    owner = {"owner_id": {"$eq": owner_id}}
+    return {"$and": [owner, search_filter]} if search_filter else owner
+
+
+def split_tags(s: str) -> List[str]:
+    """פירוק מחרוזת תגיות לרשימה."""
+    parts = [p.strip().lower() for p in s.replace("#", "").split(",")]
+    return [p for p in parts if p]
+
+
+SEARCH_TAG_RE = re.compile(r"(?<!\S)#([\w.+-]+)")
+SEARCH_DATE_RE = re.compile(r"(?<!\S)(since|until):(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?(?!\S)", re.IGNORECASE)
+
+
+def parse_date_bound(year: str, month: Optional[str], day: Optional[str], end: bool) -> Optional[datetime]:
+    """YYYY / YYYY-MM / YYYY-MM-DD לתאריך. end=True - תחילת התקופה הבאה (גבול עליון לא כולל)."""
+    try:
+        start = datetime(int(year), int(month or 1), int(day or 1))
+    except ValueError:
+        return None
+    if not end:
+        return start
+    if day:
+        return start + timedelta(days=1)
+    if month:
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return datetime(start.year + 1, 1, 1)
+
+
+def parse_search_query(text: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    פירוק שאילתה לטקסט חופשי ומסננים:
+    #tag (כל התגיות נדרשות), since:YYYY[-MM[-DD]], until:YYYY[-MM[-DD]] (כולל).
+    המסנן בנוי רק מאופרטורים ש-$vectorSearch תומך בהם, כך שמתאים גם ל-find.
+    """
+    clauses: List[Dict[str, Any]] = []
+    for tag in dict.fromkeys(t.lower() for t in SEARCH_TAG_RE.findall(text)):
+        clauses.append({"tags": {"$eq": tag}})
+    for key, year, month, day in SEARCH_DATE_RE.findall(text):
+        bound = parse_date_bound(year, month, day, end=key.lower() == "until")
+        if bound:
+            op = "$lt" if key.lower() == "until" else "$gte"
+            clauses.append({"created_at": {op: bound}})
+    
+    query = SEARCH_DATE_RE.sub(" ", SEARCH_TAG_RE.sub(" ", text))
+    query = " ".join(query.split())
+    if not clauses:
+        return query, {}
+    return query, clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def truncate_text(text: str, max_length: int = 200) -> str:
+    """קיצור טקסט עם שלוש נקודות."""
+    if len(text) <= max_length:
+        return text
+    return text[:max_length] + "…"
+
+
+def format_memory_preview(doc: Dict[str, Any], index: int = 0) -> str:
+    """פורמט תצוגה מקוצרת של זיכרון."""
+    title = doc.get("title", "(ללא כותרת)")
+    tags = doc.get("tags", [])
+    solution = truncate_text(doc.get("solution", ""), 150)
+    score = doc.get("score", 0)
+    
+    tags_str = ", ".join(tags) if tags else "(ללא תגיות)"
+    score_str = f" (התאמה: {score:.0%})" if score else ""
+    
+    return f"**{index}) {title}**{score_str}\n🏷️ {tags_str}\n📝 {solution}\n"
+
+
+def format_memory_full(doc: Dict[str, Any]) -> str:
+    """פורמט תצוגה מלאה של זיכרון."""
+    title = doc.get("title", "(ללא כותרת)")
+    tags = doc.get("tags", [])
+    solution = doc.get("solution", "")
+    code = doc.get("code", "")
+    created = doc.get("created_at")
+    
+    tags_str = ", ".join(tags) if tags else "(ללא תגיות)"
+    date_str = created.strftime("%Y-%m-%d %H:%M") if created else ""
+    
+    text = f"📌 **{title}**\n\n"
+    text += f"🏷️ תגיות: {tags_str}\n"
+    text += f"📅 נוצר: {date_str}\n\n"
+    text += f"📝 **פתרון:**\n{solution}\n"
+    
+    if code:
+        text += f"\n💻 **קוד:**\n```\n{code}\n```"
+    
+    return text
+
+
+# ---------- Keyset pagination ----------
+# הסמן הוא (created_at, _id) של הפריט הראשון/האחרון בעמוד, מקודד בקומפקטיות
+# כדי להיכנס ב-callback_data (עד 64 בתים): created_at במילישניות ב-base36,
+# וה-ObjectId ב-base64url.
+
+EPOCH = datetime(1970, 1, 1)
+CALLBACK_DATA_LIMIT = 64
+RECENT_PAGE_SIZE = 10
+TAG_PAGE_SIZE = 20
+
+
+def _to_base36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+
+def encode_cursor(doc: Dict[str, Any]) -> str:
+    """קידוד סמן מ-(created_at, _id) של מסמך."""
+    ms = (doc["created_at"] - EPOCH) // timedelta(milliseconds=1)
+    oid = base64.urlsafe_b64encode(doc["_id"].binary).decode().rstrip("=")
+    return f"{_to_base36(ms)}.{oid}"
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[datetime, ObjectId]]:
+    """פענוח סמן. מחזיר None אם הסמן פגום."""
+    try:
+        ms, oid = cursor.split(".")
+        created_at = EPOCH + timedelta(milliseconds=int(ms, 36))
+        return created_at, ObjectId(base64.urlsafe_b64decode(oid + "=="))
+    except Exception:
+        return None
+
+
+def page_callback(kind: str, direction: str, cursor: str, tag: str = "") -> Optional[str]:
+    """callback_data לכפתור דפדוף, או None אם חורג ממגבלת טלגרם."""
+    data = f"page:{kind}:{direction}:{cursor}"
+    if tag:
+        data += f":{tag}"
+    if len(data.encode("utf-8")) > CALLBACK_DATA_LIMIT:
+        return None
+    return data
+
+
+def get_pagination_keyboard(kind: str, page: Dict[str, Any], tag: str = "") -> Optional[InlineKeyboardMarkup]:
+    """כפתורי הקודם/הבא לעמוד, או None אם אין לאן לדפדף."""
+    docs = page["docs"]
+    buttons = []
+    if page["has_prev"]:
+        data = page_callback(kind, "p", encode_cursor(docs[0]), tag)
+        if data:
+            buttons.append(InlineKeyboardButton("◀️ הקודם", callback_data=data))
+    if page["has_next"]:
+        data = page_callback(kind, "n", encode_cursor(docs[-1]), tag)
+        if data:
+            buttons.append(InlineKeyboardButton("הבא ▶️", callback_data=data))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def format_recent_page(docs: List[Dict[str, Any]]) -> str:
+    """טקסט עמוד ברשימת הזיכרונות האחרונים."""
+    lines = ["📚 **הזיכרונות האחרונים:**\n"]
+    for i, d in enumerate(docs, 1):
+        dt = d.get("created_at")
+        dt_str = dt.strftime("%d/%m/%y") if dt else ""
+        title = d.get("title", "(ללא כותרת)")
+        tags = ", ".join(d.get("tags", [])) or "-"
+        lines.append(f"{i}. **{title}**\n   🏷️ {tags} | 📅 {dt_str}\n")
+    return "\n".join(lines)
+
+
+def format_tag_page(tag: str, docs: List[Dict[str, Any]]) -> str:
+    """טקסט עמוד בחיפוש לפי תגית."""
+    lines = [f"🏷️ **זיכרונות עם תגית `{tag}`:**\n"]
+    for i, d in enumerate(docs, 1):
+        dt = d.get("created_at")
+        dt_str = dt.strftime("%d/%m/%y") if dt else ""
+        lines.append(f"{i}. {d.get('title', '(ללא כותרת)')} | 📅 {dt_str}")
+    return "\n".join(lines)
+
+
+def draft_to_doc(draft: Dict[str, Any], owner_id: int) -> Dict[str, Any]:
+    """מסמך זיכרון מטיוטת השמירה."""
+    return {
+        "owner_id": owner_id,
+        "title": draft.get("title", "(ללא כותרת)"),
+        "solution": draft.get("solution", ""),
+        "tags": draft.get("tags", []),
+        "context": "",
+        "code": "",
+    }
+
+
+def reset_user_state(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """איפוס מצב המשתמש."""
+    context.user_data[MODE_KEY] = MODE_NONE
+    context.user_data.pop(DRAFT_KEY, None)
+    context.user_data.pop(LAST_RESULTS_KEY, None)
+
+
+# ==================== Database Operations ====================
+
+# להעלות בכל שינוי בתבנית של build_embedding_text (מסמנת vectors ישנים ל-re-embedding)
+EMBEDDING_TEMPLATE_VERSION = 1
+# המודל של מסמכים שנשמרו לפני שהתחלנו לרשום embedding_model
+LEGACY_EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+def build_embedding_text(doc: Dict[str, Any]) -> str:
+    """הטקסט שממנו נוצר ה-embedding של זיכרון."""
+    return f"""
+Title: {doc.get('title', '')}
+Tags: {', '.join(doc.get('tags', []))}
+Solution: {doc.get('solution', '')}
+Context: {doc.get('context', '')}
+    """.strip()
+
+
+def embedding_metadata() -> Dict[str, Any]:
+    """איזה מודל ואיזו גרסת תבנית יצרו את ה-embedding, ומתי (ה-watermark של האינדקס המקומי)."""
+    return {
+        "embedding_model": EMBEDDING_MODEL,
+        "embedding_template": EMBEDDING_TEMPLATE_VERSION,
+        "embedded_at": datetime.utcnow(),
+    }
+
+
+EMBEDDING_RETRY_DELAY = timedelta(minutes=10)  # lease / המתנה בין ניסיונות השלמה
+
+
+def pending_embedding_fields() -> Dict[str, Any]:
+    """סימון זיכרון שנשמר בלי embedding, להשלמה ברקע."""
+    return {"embedding_status": "pending", "embedding_retry_at": datetime.utcnow()}
+
+
+# שדות ה-pending שנמחקים כשה-embedding נכתב
+PENDING_EMBEDDING_UNSET = {"embedding_status": "", "embedding_retry_at": "", "embedding_claim": ""}
+
+
+def claim_pending_embeddings(limit: int) -> List[Dict[str, Any]]:
+    """
+    תפיסת זיכרונות שממתינים ל-embedding בשלוש שאילתות: מועמדים, update_many שמסמן אותם
+    ב-claim ייחודי (רק מה שעדיין פנוי), ושליפת מה שנתפס - כך שכמה workers לא מטפלים
+    באותו זיכרון. תפוס נדחה ב-EMBEDDING_RETRY_DELAY.
+    """
+    now = datetime.utcnow()
+    due = {"embedding_status": "pending", "embedding_retry_at": {"$lte": now}}
+    ids = [d["_id"] for d in memories.find(due, {"_id": 1}).limit(limit)]
+    if not ids:
+        return []
+    claim = ObjectId()
+    memories.update_many(
+        {**due, "_id": {"$in": ids}},
+        {"$set": {"embedding_retry_at": now + EMBEDDING_RETRY_DELAY, "embedding_claim": claim}}
+    )
+    return list(memories.find(
+        {"_id": {"$in": ids}, "embedding_claim": claim},
+        {"owner_id": 1, "title": 1, "solution": 1, "tags": 1, "context": 1}
+    ))
+
+
+def backfill_pending_embeddings(batch_size: int = 50) -> int:
+    """השלמת embeddings לזיכרונות שנשמרו בזמן תקלה ב-OpenAI. מחזיר כמה הושלמו."""
+    if embedding_breaker.is_open():
+        return 0
+    docs = claim_pending_embeddings(batch_size)
+    if not docs:
+        return 0
+    
+    texts = [build_embedding_text(d) for d in docs]
+    embeddings = make_embeddings(texts)
+    if EMBEDDING_NEXT_FIELD:
+        next_embeddings = make_embeddings(texts, EMBEDDING_NEXT_DIMENSIONS)
+    else:
+        next_embeddings = [[] for _ in docs]
+    
+    ops = []
+    embedded = []
+    for doc, embedding, next_embedding in zip(docs, embeddings, next_embeddings):
+        if not embedding:
+            continue  # ינוסה שוב אחרי EMBEDDING_RETRY_DELAY
+        changes = {**encode_embedding(embedding), **embedding_metadata()}
+        if EMBEDDING_NEXT_FIELD and next_embedding:
+            changes.update(encode_embedding(next_embedding, field=EMBEDDING_NEXT_FIELD))
+        # רק אם הזיכרון לא נערך בינתיים (עריכה מחליפה את ה-embedding בעצמה)
+        ops.append(UpdateOne(
+            {"_id": doc["_id"], "embedding_status": "pending"},
+            {"$set": changes, "$unset": PENDING_EMBEDDING_UNSET}
+        ))
+        embedded.append((doc, embedding))
+    if ops:
+        memories.bulk_write(ops, ordered=False)
+    if SEARCH_BACKEND == "local":
+        index = get_local_index()
+        for doc, embedding in embedded:
+            index.add(doc["_id"], embedding, doc.get("owner_id"))
+    done = len(ops)
+    
+    EMBEDDING_PENDING_BACKFILLED.inc(done)
+    if done:
+        logger.info(f"Backfilled {done}/{len(docs)} pending embeddings")
+    return done
+
+
+def content_hash(doc: Dict[str, Any]) -> str:
+    """hash של תוכן הזיכרון (בלי הבדלי רווחים ואותיות) - לזיהוי שמירה חוזרת בלי embedding."""
+    text = normalize_embedding_text(doc.get("solution", "")).lower()
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def save_memory(doc: Dict[str, Any]) -> str:
+    """
+    שמירת זיכרון חדש בלי לחכות ל-embedding: נכנס מיד כ-pending, ו-embedding_worker
+    משלים את ה-embedding ברקע. עד אז הזיכרון נמצא דרך חיפוש הטקסט.
+    """
+    doc["content_hash"] = content_hash(doc)
+    doc.update(pending_embedding_fields())
+    doc["created_at"] = doc["embedding_retry_at"]
+    doc["updated_at"] = doc["created_at"]
+    
+    result = memories.insert_one(doc)
+    update_tag_counts(doc["owner_id"], Counter(doc.get("tags", [])))
+    return str(result.inserted_id)
+
+
+DUPLICATE_CHECK_TIMEOUT = 2.0  # שניות שהשמירה מחכה לבדיקת הכפילות הוקטורית
+
+
+def find_duplicate(doc: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    זיכרון קיים שכנראה זהה לטיוטה.
+    קודם hash של התוכן (בלי קריאה ל-OpenAI), ואז השכן הקרוב מול DUPLICATE_THRESHOLD.
+    ה-embedding נשאר ב-cache, כך ש-embedding_worker שמשלים את השמירה לא ישלם עליו שוב.
+    """
+    owner_id = doc["owner_id"]
+    match = memories.find_one({"owner_id": owner_id, "content_hash": content_hash(doc)}, {"title": 1})
+    if match:
+        return {**match, "score": 1.0, "reason": "hash"}
+    if DUPLICATE_THRESHOLD <= 0:
+        return None
+    
+    embedding = make_embedding(build_embedding_text(doc))
+    if not embedding:
+        return None
+    try:
+        with VECTOR_SEARCH_LATENCY.labels(SEARCH_BACKEND).time():
+            results = VECTOR_SEARCH_BACKENDS[SEARCH_BACKEND](embedding, 1, owner_id=owner_id)
+    except Exception as e:
+        logger.warning(f"Duplicate check skipped: {e}")
+        return None
+    if results and results[0].get("score", 0) >= DUPLICATE_THRESHOLD:
+        top = results[0]
+        return {"_id": top["_id"], "title": top.get("title"), "score": top["score"], "reason": "vector"}
+    return None
+
+
+def update_memory(owner_id: int, memory_id: str, fields: Dict[str, Any]) -> bool:
+    """עדכון תוכן של זיכרון קיים: embedding חדש, ספירת תגיות ואינדקס מקומי."""
+    try:
+        oid = ObjectId(memory_id)
+    except Exception:
+        return False
+    current = memories.find_one({"_id": oid, "owner_id": owner_id}, {"title": 1, "solution": 1, "tags": 1, "context": 1, "code": 1})
+    if current is None:
+        return False
+    
+    updated = {**current, **fields}
+    text = build_embedding_text(updated)
+    embedding = make_embedding(text)
+    changes = {**fields, "content_hash": content_hash(updated), "updated_at": datetime.utcnow()}
+    changes.update(encode_embedding(embedding))
+    update: Dict[str, Any] = {"$set": changes}
+    if embedding:
+        changes.update(embedding_metadata())
+        update["$unset"] = dict(PENDING_EMBEDDING_UNSET)
+    else:
+        # הוקטור המכומת הישן שייך לתוכן הקודם (ואינדקס ה-Atlas בנוי עליו) - מוחקים
+        # אותו, וה-embedding_worker ישלים את הזיכרון כמו כל שמירה pending
+        changes.update(pending_embedding_fields())
+        update["$unset"] = {quantized_field(): "", storage_field(): ""}
+    if EMBEDDING_NEXT_FIELD:
+        next_embedding = make_embedding(text, EMBEDDING_NEXT_DIMENSIONS)
+        changes.update(encode_embedding(next_embedding, field=EMBEDDING_NEXT_FIELD))
+        if not next_embedding:
+            update.setdefault("$unset", {}).update({
+                quantized_field(EMBEDDING_NEXT_FIELD): "", storage_field(EMBEDDING_NEXT_FIELD): ""
+            })
+    
+    if memories.update_one({"_id": oid, "owner_id": owner_id}, update).matched_count == 0:
+        return False
+    forget_memory(oid)
+    
+    old_tags = Counter(current.get("tags", []))
+    new_tags = Counter(updated.get("tags", []))
+    update_tag_counts(owner_id, new_tags - old_tags)
+    update_tag_counts(owner_id, old_tags - new_tags, sign=-1)
+    if SEARCH_BACKEND == "local":
+        if embedding:
+            get_local_index().add(oid, embedding, owner_id)
+        else:
+            get_local_index().remove(oid)
+    return True
+
+
+def merge_memory(owner_id: int, memory_id: str, doc: Dict[str, Any]) -> bool:
+    """מיזוג טיוטה לזיכרון קיים: איחוד תגיות, והוספת התוכן החדש אם הוא שונה."""
+    try:
+        existing = memories.find_one({"_id": ObjectId(memory_id), "owner_id": owner_id},
+                                     {"solution": 1, "tags": 1})
+    except Exception:
+        return False
+    if existing is None:
+        return False
+    
+    fields: Dict[str, Any] = {
+        "tags": list(dict.fromkeys(existing.get("tags", []) + doc.get("tags", []))),
+    }
+    if content_hash(doc) != content_hash(existing):
+        fields["solution"] = f"{existing.get('solution', '')}\n\n---\n\n{doc.get('solution', '')}"
+    return update_memory(owner_id, memory_id, fields)
+
+
+def backfill_content_hashes(batch_size: int = 500) -> int:
+    """הוספת content_hash לזיכרונות שנשמרו לפני שהיה קיים."""
+    updated = 0
+    cursor = memories.find({"content_hash": {"$exists": False}}, {"solution": 1}).batch_size(batch_size)
+    batch: List[UpdateOne] = []
+    for doc in cursor:
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"content_hash": content_hash(doc)}}))
+        if len(batch) >= batch_size:
+            updated += memories.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += memories.bulk_write(batch, ordered=False).modified_count
+    return updated
+
+
+def assign_default_owner() -> int:
+    """שיוך זיכרונות מלפני owner_id ל-admin. מחזיר כמה שויכו."""
+    updated = memories.update_many(
+        {"owner_id": {"$exists": False}}, {"$set": {"owner_id": ADMIN_TELEGRAM_ID}}
+    ).modified_count
+    # ספירת תגיות בפורמט הישן ({_id: tag}) - נבנית מחדש לפי משתמש
+    if updated or tag_counts.find_one({"owner_id": {"$exists": False}}):
+        rebuild_tag_counts()
+    if updated:
+        logger.info(f"Assigned {updated} memories to admin {ADMIN_TELEGRAM_ID}")
+    return updated
+
+
+SEARCH_PROJECTION = {"owner_id": 1, "title": 1, "solution": 1, "tags": 1, "code": 1, "created_at": 1}
+
+ATLAS_MAX_NUM_CANDIDATES = 10000  # המקסימום ש-$vectorSearch מקבל
+MEMORY_COUNT_CACHE_SECONDS = 300
+# owner_id -> (מספר זיכרונות, מתי נספר). None = כל ה-collection.
+_memory_counts: Dict[Optional[int], Tuple[int, float]] = {}
+
+
+def get_memory_count(owner_id: Optional[int] = None) -> int:
+    """מספר הזיכרונות של משתמש (או של כולם), נשמר ל-MEMORY_COUNT_CACHE_SECONDS."""
+    now = time.monotonic()
+    value, updated = _memory_counts.get(owner_id, (0, 0.0))
+    if now - updated > MEMORY_COUNT_CACHE_SECONDS:
+        try:
+            if owner_id is None:
+                value = memories.estimated_document_count()
+            else:
+                # מכוסה ע"י האינדקס (owner_id, created_at, _id)
+                value = memories.count_documents({"owner_id": owner_id})
+        except Exception as e:
+            logger.warning(f"Memory count failed, using cached value: {e}")
+        _memory_counts[owner_id] = (value, now)
+    return int(value)
+
+
+def vector_search_plan(limit: int, override: Optional[Dict[str, Any]] = None,
+                       owner_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    הפרמטרים של $vectorSearch לפי מספר הזיכרונות של המשתמש וה-limit:
+    exact (ENN) ל-collection קטן - זול יותר ומדויק; אחרת ANN עם numCandidates
+    של limit * NUM_CANDIDATES_MULTIPLIER, שגדל לוגריתמית מעבר לסף.
+    override - תוכנית מפורשת (eval-recall), עם numCandidates שלא קטן מ-limit.
+    """
+    if override is not None:
+        if "numCandidates" in override:
+            return {"numCandidates": max(limit, min(override["numCandidates"], ATLAS_MAX_NUM_CANDIDATES))}
+        return dict(override)
+    if VECTOR_SEARCH_STRATEGY == "exact":
+        return {"exact": True}
+    count = get_memory_count(owner_id)
+    if VECTOR_SEARCH_STRATEGY == "auto" and count <= EXACT_SEARCH_THRESHOLD:
+        return {"exact": True}
+    if NUM_CANDIDATES:
+        candidates = NUM_CANDIDATES
+    else:
+        scale = 1 + max(0.0, math.log10(max(count, 1) / max(EXACT_SEARCH_THRESHOLD, 1)))
+        candidates = int(limit * NUM_CANDIDATES_MULTIPLIER * scale)
+    return {"numCandidates": max(limit, min(candidates, ATLAS_MAX_NUM_CANDIDATES))}
+
+
+def _vector_search_atlas(q_emb: List[float], limit: int,
+                         search_filter: Optional[Dict[str, Any]] = None,
+                         plan: Optional[Dict[str, Any]] = None,
+                         owner_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    חיפוש וקטורי ב-Atlas עם $vectorSearch (עם דירוג מחדש במצב מכומת).
+    plan - exact / numCandidates (ברירת מחדל: vector_search_plan לפי הזיכרונות של owner_id).
+    """
+    # pre-filter על שדות ה-filter של האינדקס (owner_id, tags, created_at)
+    search_filter = owner_filter(owner_id, search_filter)
+    pre_filter = {"filter": search_filter} if search_filter else {}
+    if EMBEDDING_STORAGE == "float":
+        return list(memories.aggregate([
+            {
+                "$vectorSearch": {
+                    "index": VECTOR_INDEX_NAME,
+                    "path": EMBEDDING_FIELD,
+                    "queryVector": q_emb,
+                    "limit": limit,
+                    **vector_search_plan(limit, plan, owner_id),
+                    **pre_filter
+                }
+            },
+            {
+                "$project": {
+                    **SEARCH_PROJECTION,
+                    "score": {"$meta": "vectorSearchScore"}
+                }
+            }
+        ]))
+    
+    candidates = list(memories.aggregate([
+        {
+            "$vectorSearch": {
+                "index": vector_index_name(),
+                "path": quantized_field(),
+                "queryVector": quantize_embedding(q_emb, EMBEDDING_STORAGE),
+                "limit": limit * RESCORE_FACTOR,
+                **vector_search_plan(limit * RESCORE_FACTOR, plan, owner_id),
+                **pre_filter
+            }
+        },
+        {"$project": {**SEARCH_PROJECTION, EMBEDDING_FIELD: 1}}
+    ]))
+    return rescore_candidates(q_emb, candidates, limit)
+
+
+def rescore_candidates(q_emb: List[float], candidates: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """דירוג מחדש של מועמדים לפי cosine בדיוק מלא. הציון בסקאלה של Atlas."""
+    if not candidates:
+        return []
+    vectors = [decode_embedding(c.pop(EMBEDDING_FIELD, None)) for c in candidates]
+    candidates = [c for c, v in zip(candidates, vectors) if len(v) == len(q_emb)]
+    vectors = [v for v in vectors if len(v) == len(q_emb)]
+    if not candidates:
+        return []
+    
+    q = np.asarray(q_emb, dtype=np.float32)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(q) or 1.0)
+    cosines = (matrix @ q) / np.where(norms == 0, 1.0, norms)
+    
+    order = np.argsort(-cosines)[:limit]
+    results = []
+    for i in order:
+        doc = candidates[i]
+        doc["score"] = (1.0 + float(cosines[i])) / 2
+        results.append(doc)
+    return results
+
+
+def _vector_search_local(q_emb: List[float], limit: int,
+                         search_filter: Optional[Dict[str, Any]] = None,
+                         plan: Optional[Dict[str, Any]] = None,
+                         owner_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """חיפוש וקטורי מדויק באינדקס המקומי (plan לא רלוונטי), ושליפת המסמכים לפי _id."""
+    allowed = None
+    if search_filter:
+        # ה-ids שעוברים את סינון התגיות/התאריכים (מכוסה ע"י האינדקסים על owner_id/tags/created_at).
+        # סינון המשתמש לבדו לא פונה ל-Mongo - הוא מסכה בתוך האינדקס.
+        allowed = [d["_id"] for d in memories.find(owner_filter(owner_id, search_filter), {"_id": 1})]
+    hits = get_local_index().search(q_emb, limit, allowed, owner_id)
+    if not hits:
+        return []
+    
+    ids = [doc_id for doc_id, _ in hits]
+    docs = {d["_id"]: d for d in memories.find({"_id": {"$in": ids}}, SEARCH_PROJECTION)}
+    
+    results = []
+    for doc_id, score in hits:
+        doc = docs.get(doc_id)
+        if doc:
+            doc["score"] = score
+            results.append(doc)
+    return results
+
+
+VECTOR_SEARCH_BACKENDS: Dict[str, Callable[..., List[Dict[str, Any]]]] = {
+    "atlas": _vector_search_atlas,
+    "local": _vector_search_local,
+}
+
+
+RRF_K = 60  # קבוע ה-Reciprocal Rank Fusion
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Dict[str, Any]]], limit: int) -> List[Dict[str, Any]]:
+    """איחוד רשימות תוצאות לפי RRF: סכום 1/(k + rank) לכל מסמך."""
+    scores: Dict[Any, float] = {}
+    docs: Dict[Any, Dict[str, Any]] = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, 1):
+            scores[doc["_id"]] = scores.get(doc["_id"], 0.0) + 1.0 / (RRF_K + rank)
+            docs.setdefault(doc["_id"], doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [docs[doc_id] for doc_id in ranked]
+
+
+PENDING_SEARCH_LIMIT = 500  # כמה זיכרונות pending לכל היותר לצרף לחיפוש
+
+
+def search_pending_text(owner_id: int, query: str, limit: int,
+                        search_filter: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """זיכרונות שעוד ממתינים ל-embedding (ולכן לא באינדקס הוקטורי), דרך חיפוש הטקסט."""
+    pending_ids = [
+        d["_id"] for d in
+        memories.find({"embedding_status": "pending", "owner_id": owner_id}, {"_id": 1})
+        .limit(PENDING_SEARCH_LIMIT)
+    ]
+    if not pending_ids:
+        return []
+    return search_memories_text(owner_id, query, limit,
+                                {**(search_filter or {}), "_id": {"$in": pending_ids}})
+
+
+def search_memories_vector(owner_id: int, query: str, limit: int = 5,
+                           search_filter: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """
+    חיפוש סמנטי בזיכרונות של owner_id (לפי SEARCH_BACKEND, ובמצב hybrid גם מילות מפתח).
+    search_filter (מ-parse_search_query) מצמצם את המועמדים כבר באינדקס.
+    """
+    if search_filter and not query.strip():
+        # רק מסננים (למשל "#redis since:2025-01") - הזיכרונות החדשים שעוברים אותם
+        return list(memories.find(owner_filter(owner_id, search_filter), SEARCH_PROJECTION)
+                    .sort([("created_at", DESCENDING), ("_id", DESCENDING)]).limit(limit))
+    
+    if embedding_breaker.is_open():
+        # OpenAI לא זמין - ישר לחיפוש מילות מפתח, בלי לחכות ל-timeout
+        SEARCH_FALLBACKS.labels("circuit_open").inc()
+        return search_memories_text(owner_id, query, limit, search_filter)
+    
+    q_emb = make_embedding(query)
+    
+    if not q_emb:
+        # Fallback לחיפוש מילות מפתח
+        SEARCH_FALLBACKS.labels("embedding_failed").inc()
+        return search_memories_text(owner_id, query, limit, search_filter)
+    
+    hybrid = SEARCH_MODE == "hybrid"
+    candidates = limit * 2 if hybrid else limit
+    try:
+        with VECTOR_SEARCH_LATENCY.labels(SEARCH_BACKEND).time():
+            results = VECTOR_SEARCH_BACKENDS[SEARCH_BACKEND](q_emb, candidates, search_filter, owner_id=owner_id)
+    except Exception as e:
+        logger.error(f"Vector search error: {e}")
+        # Fallback לחיפוש מילות מפתח
+        SEARCH_FALLBACKS.labels("vector_search_error").inc()
+        return search_memories_text(owner_id, query, limit, search_filter)
+    
+    if hybrid:
+        text_results = search_memories_text(owner_id, query, candidates, search_filter)
+        return reciprocal_rank_fusion([results, text_results], limit)
+    # זיכרונות שנשמרו זה עתה ועוד בלי embedding
+    pending = search_pending_text(owner_id, query, limit, search_filter)
+    if pending:
+        return reciprocal_rank_fusion([results, pending], limit)
+    return results
+
+
+def text_search_terms(query: str) -> str:
+    """פירוק השאילתה למילים עבור $text (בלי תחביר ביטויים/שלילה של Mongo)."""
+    return " ".join(re.findall(r"\w[\w.+#]*", query))
+
+
+def search_memories_text(owner_id: int, query: str, limit: int = 5,
+                         search_filter: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """חיפוש מילות מפתח באינדקס הטקסט (fallback), מדורג לפי textScore."""
+    terms = text_search_terms(query)
+    if not terms:
+        return []
+    
+    try:
+        # אינדקס הטקסט מתחיל ב-owner_id, ולכן חייב שוויון עליו ברמה העליונה
+        return list(memories.find(
+            {"owner_id": owner_id, "$text": {"$search": terms}, **(search_filter or {})},
+            {**SEARCH_PROJECTION, "text_score": {"$meta": "textScore"}}
+        ).sort([("text_score", {"$meta": "textScore"})]).limit(limit))
+    except Exception as e:
+        logger.error(f"Text search error: {e}")
+        return []
+
+
+LIST_PROJECTION = {"title": 1, "tags": 1, "created_at": 1}
+
+
+def get_memories_page(
+    base_filter: Dict[str, Any],
+    limit: int,
+    cursor: Optional[str] = None,
+    direction: str = "n"
+) -> Dict[str, Any]:
+    """
+    עמוד זיכרונות ב-keyset pagination על (created_at, _id), מהחדש לישן.
+    direction: "n" - אחרי הסמן (הבא), "p" - לפני הסמן (הקודם).
+    מחזיר {"docs", "has_prev", "has_next"}.
+    """
+    query = dict(base_filter)
+    backwards = False
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        created_at, oid = position
+        backwards = direction == "p"
+        op = "$gt" if backwards else "$lt"
+        query["$or"] = [
+            {"created_at": {op: created_at}},
+            {"created_at": created_at, "_id": {op: oid}},
+        ]
+    
+    order = 1 if backwards else -1
+    docs = list(memories.find(query, LIST_PROJECTION)
+                .sort([("created_at", order), ("_id", order)])
+                .limit(limit + 1))
+    more = len(docs) > limit
+    docs = docs[:limit]
+    
+    if backwards:
+        docs.reverse()
+        return {"docs": docs, "has_prev": more, "has_next": True}
+    return {"docs": docs, "has_prev": position is not None, "has_next": more}
+
+
+def search_by_tag_page(owner_id: int, tag: str, limit: int = TAG_PAGE_SIZE,
+                       cursor: Optional[str] = None, direction: str = "n") -> Dict[str, Any]:
+    """עמוד תוצאות חיפוש לפי תגית."""
+    return get_memories_page({"owner_id": owner_id, "tags": tag.lower()}, limit, cursor, direction)
+
+
+def get_recent_memories_page(owner_id: int, limit: int = RECENT_PAGE_SIZE,
+                             cursor: Optional[str] = None, direction: str = "n") -> Dict[str, Any]:
+    """עמוד בזיכרונות האחרונים."""
+    return get_memories_page({"owner_id": owner_id}, limit, cursor, direction)
+
+
+def search_by_tag(owner_id: int, tag: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """חיפוש לפי תגית."""
+    return search_by_tag_page(owner_id, tag, limit)["docs"]
+
+
+def get_recent_memories(owner_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+    """קבלת זיכרונות אחרונים."""
+    return get_recent_memories_page(owner_id, limit)["docs"]
+
+
+# ---------- Document cache ----------
+# LRU של מסמכים מוכנים לתצוגה (SEARCH_PROJECTION - בלי embedding), כדי שכפתורי
+# "הצג מלא" / "מחק" אחרי חיפוש לא יחזרו ל-Mongo. מתבטל במחיקה ובעדכון; התוקף
+# הקצר (DOC_CACHE_SECONDS) מכסה עדכונים מ-workers אחרים.
+
+_doc_cache: "OrderedDict[ObjectId, Tuple[Dict[str, Any], float]]" = OrderedDict()
+_doc_cache_lock = threading.Lock()
+doc_cache_stats = {"hits": 0, "misses": 0}
+
+
+def remember_memories(docs: Iterable[Dict[str, Any]]) -> None:
+    """הכנסת מסמכים (בפורמט SEARCH_PROJECTION) ל-cache."""
+    if DOC_CACHE_SIZE <= 0:
+        return
+    expires_at = time.monotonic() + DOC_CACHE_SECONDS
+    with _doc_cache_lock:
+        for doc in docs:
+            clean = {k: v for k, v in doc.items() if k == "_id" or k in SEARCH_PROJECTION}
+            _doc_cache[doc["_id"]] = (clean, expires_at)
+            _doc_cache.move_to_end(doc["_id"])
+        while len(_doc_cache) > DOC_CACHE_SIZE:
+            _doc_cache.popitem(last=False)
+
+
+def forget_memory(oid: ObjectId) -> None:
+    """הוצאת זיכרון מה-cache (אחרי מחיקה / עדכון)."""
+    with _doc_cache_lock:
+        _doc_cache.pop(oid, None)
+
+
+def _cached_memory(oid: ObjectId) -> Optional[Dict[str, Any]]:
+    with _doc_cache_lock:
+        entry = _doc_cache.get(oid)
+        if entry and entry[1] > time.monotonic():
+            _doc_cache.move_to_end(oid)
+            doc_cache_stats["hits"] += 1
+            DOC_CACHE_LOOKUPS.labels("hit").inc()
+            return dict(entry[0])
+        _doc_cache.pop(oid, None)
+        doc_cache_stats["misses"] += 1
+    DOC_CACHE_LOOKUPS.labels("miss").inc()
+    return None
+
+
+def get_doc_cache_stats() -> Dict[str, Any]:
+    """סטטיסטיקות cache המסמכים."""
+    with _doc_cache_lock:
+        return {"size": len(_doc_cache), **doc_cache_stats}
+
+
+def get_memory_by_id(owner_id: int, memory_id: str) -> Optional[Dict[str, Any]]:
+    """קבלת זיכרון של owner_id לפי ID, מוכן לתצוגה (בלי embedding), דרך ה-cache."""
+    try:
+        oid = ObjectId(memory_id)
+    except Exception:
+        return None
+    
+    doc = _cached_memory(oid)
+    if doc is None:
+        doc = memories.find_one({"_id": oid}, SEARCH_PROJECTION)
+        if doc is not None:
+            remember_memories([doc])
+    if doc is None or doc.get("owner_id") != owner_id:
+        return None
+    return doc
+
+
+def delete_memory(owner_id: int, memory_id: str) -> bool:
+    """מחיקת זיכרון של owner_id."""
+    try:
+        oid = ObjectId(memory_id)
+        deleted = memories.find_one_and_delete({"_id": oid, "owner_id": owner_id}, projection={"tags": 1})
+    except Exception:
+        return False
+    
+    forget_memory(oid)
+    if deleted is None:
+        return False
+    
+    update_tag_counts(owner_id, Counter(deleted.get("tags", [])), sign=-1)
+    if SEARCH_BACKEND == "local":
+        get_local_index().remove(oid)
+    return True
+
+
+def update_tag_counts(owner_id: int, counts: Dict[str, int], sign: int = 1) -> None:
+    """
+    עדכון אטומי ($inc) של ספירת התגיות של owner_id. תגיות שירדו ל-0 נמחקות.
+    נקרא בכל כתיבה, ולכן גם מבטל את הסטטיסטיקות השמורות של המשתמש.
+    """
+    forget_stats(owner_id)
+    if not counts:
+        return
+    try:
+        tag_counts.bulk_write(
+            [UpdateOne({"owner_id": owner_id, "tag": tag}, {"$inc": {"count": sign * n}}, upsert=True)
+             for tag, n in counts.items()],
+            ordered=False
+        )
+        # האינדקס בזיכרון משקף רק מה שנכתב, כדי לא לסטות מ-tag_counts
+        tag_index.apply(owner_id, counts, sign)
+        if sign < 0:
+            tag_counts.delete_many({"owner_id": owner_id, "tag": {"$in": list(counts)}, "count": {"$lte": 0}})
+    except Exception as e:
+        # הסטייה תתוקן ב-rebuild_tag_counts הבא
+        logger.error(f"Tag counts update error: {e}")
+
+
+def rebuild_tag_counts() -> int:
+    """בנייה מחדש של tag_counts מכל הזיכרונות ($out מחליף את ה-collection)."""
+    memories.aggregate([
+        {"$unwind": "$tags"},
+        {"$group": {"_id": {"owner_id": "$owner_id", "tag": "$tags"}, "count": {"$sum": 1}}},
+        {"$project": {"_id": 0, "owner_id": "$_id.owner_id", "tag": "$_id.tag", "count": 1}},
+        {"$out": tag_counts.name}
+    ])
+    # $out שומר אינדקסים של collection קיים, אבל יוצר collection חדש בלי אינדקסים
+    tag_counts.create_index([("owner_id", 1), ("tag", 1)], unique=True)
+    tag_counts.create_index([("owner_id", 1), ("count", DESCENDING)])
+    with _stats_cache_lock:
+        _stats_cache.clear()
+    tag_index.load(tag_counts)
+    total = tag_counts.estimated_document_count()
+    logger.info(f"Tag counts rebuilt: {total} tags")
+    return total
+
+
+# owner_id -> (סטטיסטיקות, מתי פג התוקף)
+_stats_cache: Dict[int, Tuple[Dict[str, Any], float]] = {}
+_stats_cache_lock = threading.Lock()
+
+
+def forget_stats(owner_id: int) -> None:
+    """ביטול הסטטיסטיקות השמורות של משתמש (אחרי כתיבה)."""
+    with _stats_cache_lock:
+        _stats_cache.pop(owner_id, None)
+
+
+def get_stats(owner_id: int) -> Dict[str, Any]:
+    """
+    סטטיסטיקות של משתמש: ספירה על האינדקס (owner_id, ...) ותגיות מ-tag_counts,
+    בלי לסרוק את הזיכרונות. נשמר ל-STATS_CACHE_SECONDS.
+    """
+    now = time.monotonic()
+    with _stats_cache_lock:
+        entry = _stats_cache.get(owner_id)
+    if entry and entry[1] > now:
+        return entry[0]
+    
+    total = memories.count_documents({"owner_id": owner_id})
+    
+    # תגיות פופולריות
+    top_tags = [
+        {"_id": t["tag"], "count": t["count"]}
+        for t in tag_counts.find({"owner_id": owner_id}, {"tag": 1, "count": 1}).sort("count", DESCENDING).limit(5)
+    ]
+    
+    stats = {
+        "total": total,
+        "top_tags": top_tags
+    }
+    if STATS_CACHE_SECONDS > 0:
+        with _stats_cache_lock:
+            _stats_cache[owner_id] = (stats, now + STATS_CACHE_SECONDS)
+    return stats
+
+
+def get_global_stats() -> Dict[str, Any]:
+    """סטטיסטיקות של כלל המשתמשים (ל-/stats): סך הזיכרונות ותגיות פופולריות מ-tag_counts."""
+    total = memories.estimated_document_count()
+    top_tags = list(tag_counts.aggregate([
+        {"$group": {"_id": "$tag", "count": {"$sum": "$count"}}},
+        {"$match": {"count": {"$gt": 0}}},
+        {"$sort": {"count": -1}},
+        {"$limit": 5}
+    ]))
+    return {
+        "total": total,
+        "top_tags": top_tags
+    }
+
+
+# ==================== Bulk Import ====================
+# ייבוא NDJSON: שורה = זיכרון. embeddings נשלחים בקבוצות, הכתיבה היא
+# insert_many לא מסודר. לכל רשומה import_key (hash של התוכן) עם אינדקס
+# ייחודי, כך שהרצה חוזרת אחרי כשל ממשיכה מאיפה שנעצרה בלי לשכפל.
+
+def parse_import_record(record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """המרת רשומת NDJSON למסמך זיכרון. מחזיר None אם אין תוכן."""
+    solution = record.get("solution") or record.get("body") or record.get("text") or ""
+    solution = str(solution).strip()
+    if not solution:
+        return None
+    
+    tags = record.get("tags")
+    if isinstance(tags, str):
+        tags = split_tags(tags)
+    elif isinstance(tags, list):
+        tags = [str(t).strip().lower() for t in tags if str(t).strip()]
+    else:
+        tags = []
+    
+    title = str(record.get("title") or "").strip() or truncate_text(solution, 60)
+    key_source = f"{title}\n{solution}"
+    
+    try:
+        # רשומה בלי owner_id (או ייבוא ישן) שייכת ל-admin
+        owner_id = int(record.get("owner_id") or ADMIN_TELEGRAM_ID)
+    except (TypeError, ValueError):
+        return None
+    
+    doc = {
+        "owner_id": owner_id,
+        "title": title,
+        "solution": solution,
+        "tags": tags,
+        "context": str(record.get("context") or ""),
+        "code": str(record.get("code") or ""),
+        "import_key": hashlib.sha256(key_source.encode("utf-8")).hexdigest(),
+    }
+    doc["content_hash"] = content_hash(doc)
+    
+    # שדות של קובץ export (שחזור): מזהה, תאריכים ו-embedding קיים.
+    # רשומה עם _id מזוהה לפיו ולא לפי import_key - זיכרונות זהים בתוכן הם עדיין זיכרונות נפרדים.
+    if ObjectId.is_valid(record.get("_id") or ""):
+        doc["_id"] = ObjectId(record["_id"])
+        del doc["import_key"]
+    for field in ("created_at", "updated_at"):
+        try:
+            doc[field] = datetime.fromisoformat(record[field])
+        except (KeyError, TypeError, ValueError):
+            pass
+    embedding = decode_export_embedding(record.get("embedding"))
+    if embedding:
+        doc[RESTORED_EMBEDDING_KEY] = embedding
+    return doc
+
+
+def import_batch(docs: List[Dict[str, Any]]) -> Dict[str, int]:
+    """ייבוא קבוצת מסמכים: דילוג על קיימים, embeddings בבקשה אחת, insert_many."""
+    summary = {"inserted": 0, "skipped": 0, "failed": 0}
+    if not docs:
+        return summary
+    
+    # רשומות שכבר יובאו (הרצה קודמת) - בלי לבזבז עליהן embeddings.
+    # שחזור (עם _id) נבדק לפי _id; ייבוא רגיל לפי (owner_id, import_key), שייחודי לכל משתמש.
+    keys_by_owner: Dict[int, List[str]] = {}
+    for d in docs:
+        if "import_key" in d:
+            keys_by_owner.setdefault(d["owner_id"], []).append(d["import_key"])
+    seen = {
+        (owner_id, d["import_key"])
+        for owner_id, keys in keys_by_owner.items()
+        for d in memories.find({"owner_id": owner_id, "import_key": {"$in": keys}}, {"import_key": 1})
+    }
+    restored_ids = [d["_id"] for d in docs if "import_key" not in d]
+    if restored_ids:
+        seen.update(d["_id"] for d in memories.find({"_id": {"$in": restored_ids}}, {"_id": 1}))
+    fresh = []
+    for d in docs:
+        key = (d["owner_id"], d["import_key"]) if "import_key" in d else d["_id"]
+        if key in seen:
+            summary["skipped"] += 1
+            continue
+        seen.add(key)
+        fresh.append(d)
+    
+    texts = [build_embedding_text(d) for d in fresh]
+    # בשחזור מ-export משתמשים בוקטור הקיים, ויוצרים embedding רק לחסרים
+    embeddings = [d.pop(RESTORED_EMBEDDING_KEY, None) or [] for d in fresh]
+    missing = [i for i, e in enumerate(embeddings) if not e]
+    for i, embedding in zip(missing, make_embeddings([texts[i] for i in missing])):
+        embeddings[i] = embedding
+    if EMBEDDING_NEXT_FIELD:
+        next_embeddings = make_embeddings(texts, EMBEDDING_NEXT_DIMENSIONS)
+    else:
+        next_embeddings = [[] for _ in fresh]
+    
+    now = datetime.utcnow()
+    to_insert = []
+    for doc, embedding, next_embedding in zip(fresh, embeddings, next_embeddings):
+        if not embedding or (EMBEDDING_NEXT_FIELD and not next_embedding):
+            # לא נכניס בלי embedding - הרצה חוזרת תנסה שוב
+            summary["failed"] += 1
+            continue
+        doc.update(encode_embedding(embedding))
+        doc.update(embedding_metadata())
+        if EMBEDDING_NEXT_FIELD:
+            doc.update(encode_embedding(next_embedding, field=EMBEDDING_NEXT_FIELD))
+        doc.setdefault("created_at", now)
+        doc.setdefault("updated_at", doc["created_at"])
+        to_insert.append(doc)
+    
+    if not to_insert:
+        return summary
+    
+    failed_rows = set()
+    try:
+        result = memories.insert_many(to_insert, ordered=False)
+        summary["inserted"] += len(result.inserted_ids)
+    except BulkWriteError as e:
+        details = e.details or {}
+        summary["inserted"] += details.get("nInserted", 0)
+        for err in details.get("writeErrors", []):
+            failed_rows.add(err.get("index"))
+            if err.get("code") == 11000:
+                summary["skipped"] += 1
+            else:
+                summary["failed"] += 1
+                logger.error(f"Import write error: {err.get('errmsg')}")
+    
+    inserted = [doc for i, doc in enumerate(to_insert) if i not in failed_rows]
+    for owner_id in {doc["owner_id"] for doc in inserted}:
+        update_tag_counts(owner_id, Counter(
+            tag for doc in inserted if doc["owner_id"] == owner_id for tag in doc["tags"]
+        ))
+    if SEARCH_BACKEND == "local":
+        index = get_local_index()
+        for doc in inserted:
+            index.add(doc["_id"], decode_embedding(doc[EMBEDDING_FIELD]), doc["owner_id"])
+    
+    return summary
+
+
+def iter_import_docs(lines: Iterable[Any], summary: Dict[str, int]) -> Iterator[Dict[str, Any]]:
+    """פירוק שורות NDJSON למסמכים. שורות פגומות נספרות ב-invalid, ושגיאה ברשומה ב-failed."""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            summary["invalid"] += 1
+            continue
+        try:
+            doc = parse_import_record(record) if isinstance(record, dict) else None
+        except Exception as e:
+            # רשומה אחת לא מפילה את כל הייבוא
+            logger.error(f"Import record failed: {e}")
+            summary["failed"] += 1
+            continue
+        if doc is None:
+            summary["invalid"] += 1
+            continue
+        yield doc
+
+
+def merge_summary(total: Dict[str, int], part: Dict[str, int]) -> None:
+    """צבירת סיכום ייבוא."""
+    for k, v in part.items():
+        total[k] = total.get(k, 0) + v
+
+
+def bulk_import(lines: Iterable[Any], batch_size: int = IMPORT_BATCH_SIZE) -> Dict[str, int]:
+    """ייבוא NDJSON מלא (סינכרוני, ל-CLI)."""
+    summary = {"inserted": 0, "skipped": 0, "failed": 0, "invalid": 0}
+    batch: List[Dict[str, Any]] = []
+    for doc in iter_import_docs(lines, summary):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            merge_summary(summary, import_batch(batch))
+            logger.info(f"Import progress: {summary}")
+            batch = []
+    merge_summary(summary, import_batch(batch))
+    return summary
+
+
+# ==================== Export / Restore ====================
+# export: NDJSON מ-cursor בצד השרת (זיכרון קבוע), embedding כ-base64 של float16/float32
+# עם המודל והתבנית שיצרו אותו. השחזור עובר דרך הייבוא הרגיל (import_batch):
+# וקטור שתואם למודל, לתבנית ולמימדים הנוכחיים נשמר כמו שהוא, והשאר מקבלים embedding חדש.
+
+EXPORT_FIELDS = ["owner_id", "title", "solution", "tags", "context", "code", "created_at", "updated_at"]
+EXPORT_BATCH_SIZE = 500
+EXPORT_DTYPES = ("float16", "float32")
+RESTORED_EMBEDDING_KEY = "_restored_embedding"  # מפתח זמני בין parse ל-import_batch
+
+
+def encode_export_embedding(doc: Dict[str, Any], dtype: str) -> Optional[Dict[str, Any]]:
+    """ה-embedding של מסמך כ-blob בינארי קומפקטי (או None אם אין)."""
+    embedding = decode_embedding(doc.get(EMBEDDING_FIELD))
+    if not embedding:
+        return None
+    data = np.asarray(embedding, dtype=np.dtype(dtype).newbyteorder("<"))
+    return {
+        "model": doc.get("embedding_model", LEGACY_EMBEDDING_MODEL),
+        "template": doc.get("embedding_template", 1),  # מסמכים ישנים נוצרו בתבנית 1
+        "dimensions": len(embedding),
+        "dtype": dtype,
+        "data": base64.b64encode(data.tobytes()).decode("ascii"),
+    }
+
+
+def decode_export_embedding(payload: Any) -> List[float]:
+    """embedding מקובץ export - רק אם תואם למודל, לתבנית ולמימדים הנוכחיים."""
+    if not isinstance(payload, dict) or np is None:
+        return []
+    if (payload.get("model") != EMBEDDING_MODEL
+            or payload.get("template") != EMBEDDING_TEMPLATE_VERSION
+            or payload.get("dimensions") != EMBEDDING_DIMENSIONS
+            or payload.get("dtype") not in EXPORT_DTYPES):
+        return []
+    try:
+        raw = base64.b64decode(payload["data"])
+        vec = np.frombuffer(raw, dtype=np.dtype(payload["dtype"]).newbyteorder("<"))
+    except (KeyError, ValueError, TypeError):
+        return []
+    if len(vec) != EMBEDDING_DIMENSIONS:
+        return []
+    return vec.astype(np.float32).tolist()
+
+
+def export_record(doc: Dict[str, Any], dtype: str) -> Dict[str, Any]:
+    """מסמך זיכרון לרשומת export."""
+    record: Dict[str, Any] = {"_id": str(doc["_id"])}
+    for field in EXPORT_FIELDS:
+        value = doc.get(field)
+        record[field] = value.isoformat() if isinstance(value, datetime) else value
+    embedding = encode_export_embedding(doc, dtype)
+    if embedding:
+        record["embedding"] = embedding
+    return record
+
+
+def iter_export_lines(dtype: str = "float16") -> Iterator[str]:
+    """כל הזיכרונות כשורות NDJSON, לפי _id, בקבוצות מה-cursor."""
+    if np is None:
+        raise RuntimeError("export requires numpy")
+    projection = {f: 1 for f in EXPORT_FIELDS + [EMBEDDING_FIELD, "embedding_model", "embedding_template"]}
+    cursor = memories.find({}, projection).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+    with cursor:
+        for doc in cursor:
+            yield json.dumps(export_record(doc, dtype), ensure_ascii=False) + "\n"
+
+
+# ==================== Embedding Storage Migration ====================
+
+def migrate_embedding_storage(storage: str = EMBEDDING_STORAGE, batch_size: int = 500) -> int:
+    """
+    המרת embeddings קיימים לשיטת האחסון הנתונה (float / int8 / binary).
+    מסמכים שכבר הומרו לא נכללים בסינון, כך שאפשר לעצור ולהמשיך.
+    """
+    if storage == "float":
+        query: Dict[str, Any] = {storage_field(): {"$exists": True}}
+    else:
+        query = {storage_field(): {"$ne": storage}, **has_embedding()}
+    
+    converted = 0
+    last_id = None
+    while True:
+        page_query = dict(query)
+        if last_id is not None:
+            page_query["_id"] = {"$gt": last_id}
+        docs = list(memories.find(page_query, {EMBEDDING_FIELD: 1}).sort("_id", 1).limit(batch_size))
+        if not docs:
+            break
+        
+        ops = []
+        for doc in docs:
+            fields = encode_embedding(decode_embedding(doc[EMBEDDING_FIELD]), storage)
+            update: Dict[str, Any] = {"$set": fields}
+            if storage == "float":
+                update["$unset"] = {quantized_field(): "", storage_field(): ""}
+            ops.append(UpdateOne({"_id": doc["_id"]}, update))
+        memories.bulk_write(ops, ordered=False)
+        
+        converted += len(docs)
+        last_id = docs[-1]["_id"]
+        logger.info(f"Storage migration: {converted} documents converted to {storage}")
+    
+    return converted
+
+
+def quantization_report(sample: int = 1000, queries: int = 50, k: int = 5) -> Dict[str, Any]:
+    """
+    השוואת recall@k וגודל אחסון בין float / int8 / binary על מדגם מהזיכרונות.
+    השאילתות הן וקטורים מהמדגם עצמו (בלי המסמך עצמו), מול חיפוש מדויק ב-float32.
+    """
+    docs = list(memories.aggregate([
+        {"$match": has_embedding()},
+        {"$sample": {"size": sample}},
+        {"$project": {EMBEDDING_FIELD: 1}}
+    ]))
+    vectors = [decode_embedding(d[EMBEDDING_FIELD]) for d in docs]
+    vectors = [v for v in vectors if len(v) == EMBEDDING_DIMENSIONS]
+    if len(vectors) <= k:
+        return {"error": "not enough embedded memories for a report"}
+    
+    x = np.asarray(vectors, dtype=np.float32)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    n_queries = min(queries, len(x))
+    
+    def top_k(scores: "np.ndarray", count: int) -> "np.ndarray":
+        scores = scores.copy()
+        scores[np.arange(n_queries), np.arange(n_queries)] = -np.inf  # בלי המסמך עצמו
+        return np.argsort(-scores, axis=1)[:, :count]
+    
+    exact_scores = x[:n_queries] @ x.T
+    truth = top_k(exact_scores, k)
+    
+    def recall(found: "np.ndarray") -> float:
+        hits = sum(len(set(truth[i]) & set(found[i])) for i in range(n_queries))
+        return round(hits / (n_queries * k), 4)
+    
+    def rescored(approx_scores: "np.ndarray") -> "np.ndarray":
+        candidates = top_k(approx_scores, k * RESCORE_FACTOR)
+        exact = np.take_along_axis(exact_scores, candidates, axis=1)
+        return np.take_along_axis(candidates, np.argsort(-exact, axis=1)[:, :k], axis=1)
+    
+    peaks = np.abs(x).max(axis=1, keepdims=True)
+    x_int8 = np.clip(np.rint(x / peaks * 127), -127, 127).astype(np.float32)
+    x_int8 /= np.linalg.norm(x_int8, axis=1, keepdims=True)
+    int8_scores = x_int8[:n_queries] @ x_int8.T
+    
+    bits = (x > 0).astype(np.float32)
+    # התאמת ביטים = d - hamming
+    binary_scores = bits[:n_queries] @ bits.T + (1 - bits[:n_queries]) @ (1 - bits.T)
+    
+    def bson_size(value: Any) -> int:
+        return len(bson.encode({"embedding": value}))
+    
+    sample_vec = vectors[0]
+    float64_bytes = bson_size(sample_vec)
+    float32_bytes = bson_size(Binary.from_vector(sample_vec, BinaryVectorDtype.FLOAT32))
+    report = {
+        "sample": len(x),
+        "queries": n_queries,
+        "k": k,
+        "rescore_factor": RESCORE_FACTOR,
+        "float": {"index_bytes": float64_bytes, "document_bytes": float64_bytes, "recall": 1.0},
+    }
+    for storage, scores in (("int8", int8_scores), ("binary", binary_scores)):
+        index_bytes = bson_size(quantize_embedding(sample_vec, storage))
+        report[storage] = {
+            "index_bytes": index_bytes,
+            "document_bytes": index_bytes + float32_bytes,
+            "index_reduction": round(float64_bytes / index_bytes, 1),
+            "recall": recall(top_k(scores, k)),
+            "recall_rescored": recall(rescored(scores)),
+        }
+    return report
+
+
+def eval_recall(queries: int = 50, k: int = 5, candidates: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    recall@k של החיפוש הוקטורי מול brute force על כל ה-collection.
+    השאילתות הן וקטורים של זיכרונות אקראיים (בלי הזיכרון עצמו). נבדקות ההגדרות הנוכחיות,
+    exact, ו-numCandidates נוספים לפי candidates.
+    """
+    sample = list(memories.aggregate([
+        {"$match": has_embedding()},
+        {"$sample": {"size": queries}},
+        {"$project": {EMBEDDING_FIELD: 1}}
+    ]))
+    sample = [d for d in sample if len(decode_embedding(d[EMBEDDING_FIELD])) == EMBEDDING_DIMENSIONS]
+    if not sample:
+        return {"error": "no embedded memories"}
+    
+    query_ids = [d["_id"] for d in sample]
+    query_rows = {doc_id: i for i, doc_id in enumerate(query_ids)}
+    q = np.asarray([decode_embedding(d[EMBEDDING_FIELD]) for d in sample], dtype=np.float32)
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    
+    # brute force בקבוצות - הזיכרון תלוי בגודל הקבוצה ולא ב-collection
+    best_scores = np.full((len(q), k), -np.inf, dtype=np.float32)
+    best_ids = np.empty((len(q), k), dtype=object)
+    cursor = memories.find(has_embedding(), {EMBEDDING_FIELD: 1}).batch_size(1000)
+    batch: List[Dict[str, Any]] = []
+    
+    def flush() -> None:
+        nonlocal best_scores, best_ids
+        vectors = [decode_embedding(d[EMBEDDING_FIELD]) for d in batch]
+        rows = [i for i, v in enumerate(vectors) if len(v) == EMBEDDING_DIMENSIONS]
+        if not rows:
+            return
+        ids = np.empty(len(rows), dtype=object)
+        ids[:] = [batch[i]["_id"] for i in rows]
+        x = np.asarray([vectors[i] for i in rows], dtype=np.float32)
+        norms = np.linalg.norm(x, axis=1, keepdims=True)
+        x /= np.where(norms == 0, 1.0, norms)
+        scores = q @ x.T
+        for col, doc_id in enumerate(ids):
+            if doc_id in query_rows:
+                scores[query_rows[doc_id], col] = -np.inf
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_ids = np.concatenate([best_ids, np.broadcast_to(ids, scores.shape)], axis=1)
+        top = np.argsort(-merged_scores, axis=1)[:, :k]
+        best_scores = np.take_along_axis(merged_scores, top, axis=1)
+        best_ids = np.take_along_axis(merged_ids, top, axis=1)
+    
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= 1000:
+            flush()
+            batch = []
+    flush()
+    truth = [set(row) - {None} for row in best_ids]
+    
+    plans: List[Tuple[str, Optional[Dict[str, Any]]]] = [("current", None), ("exact", {"exact": True})]
+    plans += [(f"numCandidates={n}", {"numCandidates": n}) for n in candidates or []]
+    search = VECTOR_SEARCH_BACKENDS[SEARCH_BACKEND]
+    report: Dict[str, Any] = {
+        "backend": SEARCH_BACKEND,
+        "memories": get_memory_count(),
+        "queries": len(q),
+        "k": k,
+        "current_plan": vector_search_plan(k + 1),
+        "results": {},
+    }
+    for name, plan in plans:
+        hits = 0
+        total = 0
+        started = time.perf_counter()
+        for doc_id, vec, expected in zip(query_ids, q, truth):
+            found = [d["_id"] for d in search(vec.tolist(), k + 1, None, plan) if d["_id"] != doc_id][:k]
+            hits += len(expected & set(found))
+            total += len(expected)
+        report["results"][name] = {
+            "recall": round(hits / total, 4) if total else None,
+            "mean_ms": round((time.perf_counter() - started) * 1000 / len(q), 2),
+        }
+    return report
+
+
+# ==================== Dimension Migration ====================
+# מעבר למימדים אחרים בלי הפסקת שירות:
+#   1. EMBEDDING_NEXT_FIELD + EMBEDDING_NEXT_DIMENSIONS - שמירות חדשות נכתבות לשני השדות
+#   2. python main.py atlas-index --next - יצירת אינדקס Atlas לשדה החדש
+#   3. python main.py backfill-next - מילוי השדה החדש למסמכים הקיימים
+#   4. מעבר: EMBEDDING_FIELD / EMBEDDING_DIMENSIONS / VECTOR_INDEX_NAME לערכים החדשים
+# לאורך כל התהליך החיפוש ממשיך לעבוד מהשדה הישן.
+
+def backfill_next_embeddings(batch_size: int = EMBEDDING_BATCH_SIZE) -> int:
+    """מילוי EMBEDDING_NEXT_FIELD למסמכים שעדיין אין להם (לפי סדר _id)."""
+    if not EMBEDDING_NEXT_FIELD:
+        raise RuntimeError("EMBEDDING_NEXT_FIELD is not set")
+    
+    query = {EMBEDDING_NEXT_FIELD: {"$exists": False}}
+    projection = {"title": 1, "tags": 1, "solution": 1, "context": 1}
+    filled = 0
+    last_id = None
+    while True:
+        page_query = dict(query)
+        if last_id is not None:
+            page_query["_id"] = {"$gt": last_id}
+        docs = list(memories.find(page_query, projection).sort("_id", 1).limit(batch_size))
+        if not docs:
+            break
+        
+        embeddings = make_embeddings([build_embedding_text(d) for d in docs], EMBEDDING_NEXT_DIMENSIONS)
+        ops = [
+            UpdateOne({"_id": d["_id"]}, {"$set": encode_embedding(e, field=EMBEDDING_NEXT_FIELD)})
+            for d, e in zip(docs, embeddings) if e
+        ]
+        if ops:
+            memories.bulk_write(ops, ordered=False)
+        
+        filled += len(ops)
+        last_id = docs[-1]["_id"]
+        logger.info(f"Backfill {EMBEDDING_NEXT_FIELD}: {filled} documents")
+    
+    return filled
+
+
+# ==================== Re-embedding Job ====================
+# יצירה מחדש של embeddings אחרי שינוי EMBEDDING_MODEL או התבנית.
+# עובר על הזיכרונות לפי סדר _id, שולח קבוצות במקביל (REEMBED_CONCURRENCY)
+# תחת מגבלת טוקנים לדקה, וכותב ב-bulk_write. ה-checkpoint נשמר ב-jobs,
+# כך שאחרי קריסה או כיבוי המשימה ממשיכה מה-_id האחרון שנכתב.
+
+REEMBED_JOB_ID = "reembed"
+REEMBED_LEASE_MINUTES = 5  # checkpoint ישן מזה = ה-worker שהריץ אותו מת
+_reembed_stop = threading.Event()
+
+
+class TokenRateLimiter:
+    """מגבלת טוקנים לדקה (token bucket), משותפת לכל ה-threads."""
+    
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = float(tokens_per_minute)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, tokens: int) -> None:
+        """המתנה עד שיש מספיק טוקנים."""
+        tokens = min(float(tokens), self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.capacity / 60)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) * 60 / self.capacity
+            time.sleep(wait)
+
+
+def estimate_tokens(text: str) -> int:
+    """הערכה גסה של מספר הטוקנים (~4 תווים לטוקן)."""
+    return len(text) // 4 + 1
+
+
+def stale_embedding_filter() -> Dict[str, Any]:
+    """מסמכים שה-embedding שלהם חסר, או נוצר במודל / בתבנית אחרים."""
+    models: List[Any] = [EMBEDDING_MODEL]
+    if EMBEDDING_MODEL == LEGACY_EMBEDDING_MODEL:
+        models.append(None)
+    templates: List[Any] = [EMBEDDING_TEMPLATE_VERSION]
+    if EMBEDDING_TEMPLATE_VERSION == 1:
+        templates.append(None)
+    return {"$or": [
+        {"embedding_model": {"$nin": models}},
+        {"embedding_template": {"$nin": templates}},
+        {EMBEDDING_FIELD: {"$in": [[], None]}},
+    ]}
+
+
+def _claim_reembed_job() -> Optional[Dict[str, Any]]:
+    """תפיסת המשימה (lease). מחזיר None אם worker אחר מריץ אותה כרגע."""
+    now = datetime.utcnow()
+    target = {"target_model": EMBEDDING_MODEL, "target_template": EMBEDDING_TEMPLATE_VERSION}
+    current = jobs.find_one({"_id": REEMBED_JOB_ID}) or {}
+    resume = (
+        current.get("status") in ("running", "paused", "failed")
+        and all(current.get(k) == v for k, v in target.items())
+    )
+    fresh = {} if resume else {
+        "last_id": None, "processed": 0, "updated": 0, "failed": 0,
+        "total": memories.count_documents(stale_embedding_filter()),
+        "started_at": now,
+    }
+    
+    lease_expired = now - timedelta(minutes=REEMBED_LEASE_MINUTES)
+    try:
+        return jobs.find_one_and_update(
+            {"_id": REEMBED_JOB_ID,
+             "$or": [{"status": {"$ne": "running"}}, {"updated_at": {"$lt": lease_expired}}]},
+            {"$set": {**target, **fresh, "status": "running", "updated_at": now, "error": None}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return None
+
+
+def _reembed_batch(docs: List[Dict[str, Any]], limiter: TokenRateLimiter) -> Tuple[int, int]:
+    """embedding מחדש לקבוצה אחת וכתיבה ב-bulk_write. מחזיר (עודכנו, נכשלו)."""
+    texts = [build_embedding_text(d) for d in docs]
+    tokens = sum(estimate_tokens(t) for t in texts)
+    limiter.acquire(tokens * 2 if EMBEDDING_NEXT_FIELD else tokens)
+    embeddings = make_embeddings(texts)
+    if EMBEDDING_NEXT_FIELD:
+        # בזמן מיגרציית מימדים גם השדה החדש נכתב, כמו בכל שמירה
+        next_embeddings = make_embeddings(texts, EMBEDDING_NEXT_DIMENSIONS)
+    else:
+        next_embeddings = [[] for _ in docs]
+    
+    ops = []
+    for doc, embedding, next_embedding in zip(docs, embeddings, next_embeddings):
+        if embedding:
+            fields = {**encode_embedding(embedding), **embedding_metadata(), "updated_at": datetime.utcnow()}
+            if EMBEDDING_NEXT_FIELD and next_embedding:
+                fields.update(encode_embedding(next_embedding, field=EMBEDDING_NEXT_FIELD))
+            # זיכרון שחיכה ל-embedding כבר לא pending
+            ops.append(UpdateOne({"_id": doc["_id"]}, {
+                "$set": fields, "$unset": PENDING_EMBEDDING_UNSET
+            }))
+    if ops:
+        memories.bulk_write(ops, ordered=False)
+    
+    if SEARCH_BACKEND == "local":
+        index = get_local_index()
+        for doc, embedding in zip(docs, embeddings):
+            if embedding:
+                index.add(doc["_id"], embedding, doc.get("owner_id"))
+    return len(ops), len(docs) - len(ops)
 
 
-def search_memories_vector(query: str, limit: int = 5) -> List[Dict[str, Any]]:
-    """חיפוש סמנטי בזיכרונות עם Vector Search."""
-    q_emb = make_embedding(query)
+def run_reembed_job(batch_size: int = EMBEDDING_BATCH_SIZE) -> Dict[str, Any]:
+    """הרצת משימת ה-re-embedding עד הסוף (או עד עצירה). מחזיר את הסטטוס."""
+    job = _claim_reembed_job()
+    if job is None:
+        logger.info("Re-embedding job already running elsewhere")
+        return get_reembed_status()
     
-    if not q_emb:
-        # Fallback לחיפוש טקסט פשוט
-        return search_memories_text(query, limit)
+    _reembed_stop.clear()
+    limiter = TokenRateLimiter(REEMBED_TOKENS_PER_MINUTE)
+    projection = {"owner_id": 1, "title": 1, "tags": 1, "solution": 1, "context": 1}
+    last_id = job.get("last_id")
+    logger.info(f"Re-embedding started from {last_id or 'the beginning'}")
     
     try:
-        pipeline = [
-            {
-                "$vectorSearch": {
-                    "index": VECTOR_INDEX_NAME,
-                    "path": "embedding",
-                    "queryVector": q_emb,
-                    "numCandidates": 100,
-                    "limit": limit
-                }
-            },
-            {
-                "$project": {
-                    "title": 1,
-                    "solution": 1,
-                    "tags": 1,
-                    "code": 1,
-                    "created_at": 1,
-                    "score": {"$meta": "vectorSearchScore"}
-                }
-            }
-        ]
-        
-        results = list(memories.aggregate(pipeline))
-        return results
+        with ThreadPoolExecutor(max_workers=REEMBED_CONCURRENCY) as pool:
+            while not _reembed_stop.is_set():
+                # גל של עד REEMBED_CONCURRENCY קבוצות; ה-checkpoint מתקדם רק אחרי שכולן נכתבו
+                query = stale_embedding_filter()
+                if last_id is not None:
+                    query = {"$and": [query, {"_id": {"$gt": last_id}}]}
+                docs = list(memories.find(query, projection).sort("_id", 1)
+                            .limit(batch_size * REEMBED_CONCURRENCY))
+                if not docs:
+                    break
+                
+                batches = [docs[i:i + batch_size] for i in range(0, len(docs), batch_size)]
+                results = list(pool.map(lambda b: _reembed_batch(b, limiter), batches))
+                last_id = docs[-1]["_id"]
+                jobs.update_one({"_id": REEMBED_JOB_ID}, {
+                    "$set": {"last_id": last_id, "updated_at": datetime.utcnow()},
+                    "$inc": {
+                        "processed": len(docs),
+                        "updated": sum(r[0] for r in results),
+                        "failed": sum(r[1] for r in results),
+                    }
+                })
         
+        status = "paused" if _reembed_stop.is_set() else "done"
+        jobs.update_one({"_id": REEMBED_JOB_ID},
+                        {"$set": {"status": status, "updated_at": datetime.utcnow()}})
     except Exception as e:
-        logger.error(f"Vector search error: {e}")
-        # Fallback לחיפוש טקסט
-        return search_memories_text(query, limit)
+        logger.error(f"Re-embedding job failed: {e}")
+        jobs.update_one({"_id": REEMBED_JOB_ID},
+                        {"$set": {"status": "failed", "error": str(e), "updated_at": datetime.utcnow()}})
+    
+    status = get_reembed_status()
+    logger.info(f"Re-embedding {status['status']}: {status}")
+    return status
 
 
-def search_memories_text(query: str, limit: int = 5) -> List[Dict[str, Any]]:
-    """חיפוש טקסט פשוט (fallback)."""
-    # חיפוש במילים הראשונות של השאילתה
-    search_term = query[:50]
-    
-    results = list(memories.find(
-        {
-            "$or": [
-                {"title": {"$regex": search_term, "$options": "i"}},
-                {"solution": {"$regex": search_term, "$options": "i"}},
-                {"tags": {"$regex": search_term, "$options": "i"}},
-            ]
-        },
-        {"title": 1, "solution": 1, "tags": 1, "code": 1, "created_at": 1}
-    ).sort("created_at", -1).limit(limit))
+def start_reembed_job() -> bool:
+    """הפעלת המשימה ב-thread רקע. מחזיר False אם היא כבר רצה."""
+    status = get_reembed_status()
+    if status["status"] == "running" and not status.get("stale"):
+        return False
+    threading.Thread(target=run_reembed_job, name="reembed", daemon=True).start()
+    return True
+
+
+def get_reembed_status() -> Dict[str, Any]:
+    """מצב המשימה להצגה (API / טלגרם)."""
+    job = jobs.find_one({"_id": REEMBED_JOB_ID})
+    if not job:
+        return {"status": "idle", "pending": memories.count_documents(stale_embedding_filter())}
     
-    return results
+    job.pop("_id", None)
+    if job.get("last_id") is not None:
+        job["last_id"] = str(job["last_id"])
+    total = job.get("total") or 0
+    job["percent"] = round(100 * job.get("processed", 0) / total, 1) if total else 100.0
+    updated_at = job.get("updated_at")
+    job["stale"] = bool(
+        job.get("status") == "running" and updated_at
+        and updated_at < datetime.utcnow() - timedelta(minutes=REEMBED_LEASE_MINUTES)
+    )
+    for key in ("started_at", "updated_at"):
+        if job.get(key):
+            job[key] = job[key].isoformat()
+    return job
 
 
-def search_by_tag(tag: str, limit: int = 20) -> List[Dict[str, Any]]:
-    """חיפוש לפי תגית."""
-    return list(memories.find(
-        {"tags": tag.lower()},
-        {"title": 1, "tags": 1, "created_at": 1}
-    ).sort("created_at", -1).limit(limit))
+# ==================== Async Wrappers ====================
+# pymongo וה-client של OpenAI סינכרוניים. כדי לא לחסום את ה-event loop
+# של uvicorn, כל פעולה כזו רצה ב-thread pool חסום בגודלו.
 
+_blocking_pool = ThreadPoolExecutor(
+    max_workers=BLOCKING_POOL_SIZE,
+    thread_name_prefix="blocking"
+)
 
-def get_recent_memories(limit: int = 10) -> List[Dict[str, Any]]:
-    """קבלת זיכרונות אחרונים."""
-    return list(memories.find(
-        {},
-        {"title": 1, "tags": 1, "created_at": 1}
-    ).sort("created_at", -1).limit(limit))
+
+async def run_blocking(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """הרצת פונקציה חוסמת ב-thread pool והמתנה לתוצאה."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _blocking_pool, functools.partial(func, *args, **kwargs)
+    )
 
 
-def get_memory_by_id(memory_id: str) -> Optional[Dict[str, Any]]:
-    """קבלת זיכרון לפי ID."""
-    from bson import ObjectId
-    try:
-        return memories.find_one({"_id": ObjectId(memory_id)})
-    except Exception:
-        return None
+async def save_memory_async(doc: Dict[str, Any]) -> str:
+    """שמירה מיידית (save_memory) והערת ה-embedding_worker."""
+    memory_id = await run_blocking(save_memory, doc)
+    _embedding_wakeup.set()
+    return memory_id
 
 
-def delete_memory(memory_id: str) -> bool:
-    """מחיקת זיכרון."""
-    from bson import ObjectId
-    try:
-        result = memories.delete_one({"_id": ObjectId(memory_id)})
-        return result.deleted_count > 0
-    except Exception:
-        return False
+async def search_memories_vector_async(owner_id: int, query: str, limit: int = 5,
+                                      search_filter: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """גרסה אסינכרונית של search_memories_vector."""
+    return await run_blocking(search_memories_vector, owner_id, query, limit, search_filter)
 
 
-def get_stats() -> Dict[str, Any]:
-    """קבלת סטטיסטיקות."""
-    total = memories.count_documents({})
-    
-    # תגיות פופולריות
-    tag_pipeline = [
-        {"$unwind": "$tags"},
-        {"$group": {"_id": "$tags", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 5}
-    ]
-    top_tags = list(memories.aggregate(tag_pipeline))
-    
-    return {
-        "total": total,
-        "top_tags": top_tags
-    }
+async def search_memories_text_async(owner_id: int, query: str, limit: int = 5,
+                                    search_filter: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """גרסה אסינכרונית של search_memories_text."""
+    return await run_blocking(search_memories_text, owner_id, query, limit, search_filter)
+
+
+async def search_by_tag_async(owner_id: int, tag: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """גרסה אסינכרונית של search_by_tag."""
+    return await run_blocking(search_by_tag, owner_id, tag, limit)
+
+
+async def get_recent_memories_async(owner_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+    """גרסה אסינכרונית של get_recent_memories."""
+    return await run_blocking(get_recent_memories, owner_id, limit)
+
+
+async def search_by_tag_page_async(owner_id: int, tag: str, limit: int = TAG_PAGE_SIZE,
+                                   cursor: Optional[str] = None, direction: str = "n") -> Dict[str, Any]:
+    """גרסה אסינכרונית של search_by_tag_page."""
+    return await run_blocking(search_by_tag_page, owner_id, tag, limit, cursor, direction)
+
+
+async def get_recent_memories_page_async(owner_id: int, limit: int = RECENT_PAGE_SIZE,
+                                         cursor: Optional[str] = None, direction: str = "n") -> Dict[str, Any]:
+    """גרסה אסינכרונית של get_recent_memories_page."""
+    return await run_blocking(get_recent_memories_page, owner_id, limit, cursor, direction)
+
+
+async def get_memory_by_id_async(owner_id: int, memory_id: str) -> Optional[Dict[str, Any]]:
+    """גרסה אסינכרונית של get_memory_by_id."""
+    return await run_blocking(get_memory_by_id, owner_id, memory_id)
+
+
+async def find_duplicate_async(doc: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """גרסה אסינכרונית של find_duplicate."""
+    return await run_blocking(find_duplicate, doc)
+
+
+async def update_memory_async(owner_id: int, memory_id: str, fields: Dict[str, Any]) -> bool:
+    """גרסה אסינכרונית של update_memory."""
+    return await run_blocking(update_memory, owner_id, memory_id, fields)
+
+
+async def merge_memory_async(owner_id: int, memory_id: str, doc: Dict[str, Any]) -> bool:
+    """גרסה אסינכרונית של merge_memory."""
+    return await run_blocking(merge_memory, owner_id, memory_id, doc)
+
+
+async def delete_memory_async(owner_id: int, memory_id: str) -> bool:
+    """גרסה אסינכרונית של delete_memory."""
+    return await run_blocking(delete_memory, owner_id, memory_id)
+
+
+async def get_stats_async(owner_id: int) -> Dict[str, Any]:
+    """גרסה אסינכרונית של get_stats."""
+    return await run_blocking(get_stats, owner_id)
+
+
+async def get_reembed_status_async() -> Dict[str, Any]:
+    """גרסה אסינכרונית של get_reembed_status."""
+    return await run_blocking(get_reembed_status)
+
+
+async def start_reembed_job_async() -> bool:
+    """גרסה אסינכרונית של start_reembed_job."""
+    return await run_blocking(start_reembed_job)
+
+
+async def import_batch_async(docs: List[Dict[str, Any]]) -> Dict[str, int]:
+    """גרסה אסינכרונית של import_batch."""
+    return await run_blocking(import_batch, docs)
 
 
 # ==================== Handlers ====================
 
+@with_conversation_state
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """פקודת התחלה."""
-    if not is_admin(update):
+    if not is_allowed(update):
         await update.message.reply_text("🔒 סליחה, הבוט הזה פרטי.")
         return
     
@@ -374,7 +3311,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """פקודת עזרה."""
-    if not is_admin(update):
+    if not is_allowed(update):
         return
     
     await update.message.reply_text(
@@ -384,19 +3321,52 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "📚 **רשימת זיכרונות** - הזיכרונות האחרונים\n"
         "🏷️ **חיפוש לפי תגית** - סינון לפי תגיות\n"
         "📊 **סטטיסטיקות** - נתונים על הזיכרונות\n\n"
+        "🔍 **סינון בחיפוש:** `#tag`, `since:2025-01`, `until:2025-06`\n\n"
         "💡 **טיפ:** כשאתה שומר, תן כותרת ברורה ותגיות רלוונטיות.",
         reply_markup=MAIN_KEYBOARD,
         parse_mode="Markdown"
     )
 
 
+def format_reembed_status(status: Dict[str, Any]) -> str:
+    """טקסט סטטוס משימת ה-re-embedding."""
+    if status["status"] == "idle":
+        return f"🔄 Re-embedding: לא הורץ. ממתינים: {status['pending']}"
+    text = (
+        f"🔄 Re-embedding: **{status['status']}**\n"
+        f"📈 התקדמות: {status.get('processed', 0)}/{status.get('total', 0)} ({status['percent']}%)\n"
+        f"✅ עודכנו: {status.get('updated', 0)} | ❌ נכשלו: {status.get('failed', 0)}\n"
+        f"🤖 מודל: `{status.get('target_model')}` | תבנית: v{status.get('target_template')}"
+    )
+    if status.get("error"):
+        text += f"\n⚠️ {status['error']}"
+    return text
+
+
+async def cmd_reembed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """פקודת /reembed - סטטוס, או /reembed start להפעלה."""
+    if not is_admin(update):
+        return
+    
+    if context.args and context.args[0] == "start":
+        started = await start_reembed_job_async()
+        await update.message.reply_text("🚀 המשימה הופעלה." if started else "⏳ המשימה כבר רצה.")
+        return
+    
+    status = await get_reembed_status_async()
+    await update.message.reply_text(format_reembed_status(status), parse_mode="Markdown")
+
+
+@with_conversation_state
+@timed_handler("message", message_route)
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handler ראשי לכל ההודעות.
     מנתב לפי מצב השיחה הנוכחי.
     """
-    if not is_admin(update):
+    if not is_allowed(update):
         return
+    owner_id = owner_of(update)
     
     text = (update.message.text or "").strip()
     mode = context.user_data.get(MODE_KEY, MODE_NONE)
@@ -425,16 +3395,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "דוגמאות:\n"
             "• איך פתרנו את בעיית ה-caching?\n"
             "• מה עשינו עם timeout ב-Render?\n"
-            "• טיפול ב-race condition",
+            "• טיפול ב-race condition\n"
+            "• #redis since:2025-01 timeout (סינון לפי תגית ותאריך)",
             reply_markup=CANCEL_KEYBOARD
         )
         return
     
     if text == "📚 רשימת זיכרונות":
         reset_user_state(context)
-        docs = get_recent_memories(10)
+        page = await get_recent_memories_page_async(owner_id)
         
-        if not docs:
+        if not page["docs"]:
             await update.message.reply_text(
                 "📭 אין עדיין זיכרונות שמורים.\n"
                 "לחץ על ➕ שמור פתרון כדי להתחיל!",
@@ -442,17 +3413,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return
         
-        lines = ["📚 **הזיכרונות האחרונים:**\n"]
-        for i, d in enumerate(docs, 1):
-            dt = d.get("created_at")
-            dt_str = dt.strftime("%d/%m/%y") if dt else ""
-            title = d.get("title", "(ללא כותרת)")
-            tags = ", ".join(d.get("tags", [])) or "-"
-            lines.append(f"{i}. **{title}**\n   🏷️ {tags} | 📅 {dt_str}\n")
-        
         await update.message.reply_text(
-            "\n".join(lines),
-            reply_markup=MAIN_KEYBOARD,
+            format_recent_page(page["docs"]),
+            reply_markup=get_pagination_keyboard("r", page) or MAIN_KEYBOARD,
             parse_mode="Markdown"
         )
         return
@@ -460,23 +3423,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if text == "🏷️ חיפוש לפי תגית":
         context.user_data[MODE_KEY] = MODE_TAG_SEARCH_WAIT
         
-        # הצגת תגיות קיימות
-        stats = get_stats()
-        tags_info = ""
-        if stats["top_tags"]:
-            tags_list = [f"`{t['_id']}`" for t in stats["top_tags"]]
-            tags_info = f"\n\n📊 תגיות פופולריות: {', '.join(tags_list)}"
-        
         await update.message.reply_text(
-            f"🏷️ כתוב תגית אחת לחיפוש:{tags_info}",
-            reply_markup=CANCEL_KEYBOARD,
-            parse_mode="Markdown"
+            "🏷️ כתוב תגית אחת לחיפוש:",
+            reply_markup=CANCEL_KEYBOARD
         )
+        # התגיות הפופולריות מאינדקס התגיות, בלי פנייה ל-Mongo
+        suggestions = get_tag_suggestions_keyboard(tag_index.top(owner_id, TAG_SUGGESTIONS))
+        if suggestions:
+            await update.message.reply_text("📊 תגיות פופולריות:", reply_markup=suggestions)
         return
     
     if text == "📊 סטטיסטיקות":
         reset_user_state(context)
-        stats = get_stats()
+        stats = await get_stats_async(owner_id)
         
         tags_text = ""
         if stats["top_tags"]:
@@ -554,7 +3513,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         await update.message.reply_text("🔍 מחפש...")
         
-        results = search_memories_vector(text, limit=5)
+        query, search_filter = parse_search_query(text)
+        results = await search_memories_vector_async(owner_id, query, 5, search_filter)
         
         if not results:
             await update.message.reply_text(
@@ -564,8 +3524,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return
         
-        # שמירת תוצאות לפעולות המשך
-        context.user_data[LAST_RESULTS_KEY] = results
+        # שמירת ids של התוצאות לפעולות המשך (לא את המסמכים עצמם);
+        # המסמכים נכנסים ל-cache כדי ש"הצג" / "מחק" לא יחזרו ל-Mongo
+        context.user_data[LAST_RESULTS_KEY] = [str(doc["_id"]) for doc in results]
+        remember_memories(results)
         
         lines = [f"🧠 **מצאתי {len(results)} זיכרונות רלוונטיים:**\n"]
         for i, doc in enumerate(results, 1):
@@ -592,9 +3554,26 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         reset_user_state(context)
         tag = text.strip().lower().replace("#", "")
         
-        docs = search_by_tag(tag, limit=20)
+        note = ""
+        # קודם השאילתה עצמה (על האינדקס): ה-tag_index של התהליך יכול לפגר אחרי
+        # תגית שנוצרה ב-worker אחר, ואסור להחליף תגית אמיתית בתגית דומה
+        page = await search_by_tag_page_async(owner_id, tag)
+        if not page["docs"] and tag_index.loaded:
+            # אין תוצאות: השלמה / תיקון שגיאת הקלדה מהאינדקס
+            suggestions = tag_index.suggest(owner_id, tag, TAG_SUGGESTIONS)
+            if len(suggestions) > 1:
+                await update.message.reply_text(
+                    f"🤔 אין תגית `{tag}`. אולי התכוונת ל:",
+                    reply_markup=get_tag_suggestions_keyboard(suggestions),
+                    parse_mode="Markdown"
+                )
+                return
+            if suggestions:
+                tag = suggestions[0][0]
+                note = f"🔤 מציג את `{tag}`\n\n"
+                page = await search_by_tag_page_async(owner_id, tag)
         
-        if not docs:
+        if not page["docs"]:
             await update.message.reply_text(
                 f"😕 לא מצאתי זיכרונות עם התגית `{tag}`.",
                 reply_markup=MAIN_KEYBOARD,
@@ -602,15 +3581,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return
         
-        lines = [f"🏷️ **זיכרונות עם תגית `{tag}`:**\n"]
-        for i, d in enumerate(docs, 1):
-            dt = d.get("created_at")
-            dt_str = dt.strftime("%d/%m/%y") if dt else ""
-            lines.append(f"{i}. {d.get('title', '(ללא כותרת)')} | 📅 {dt_str}")
-        
         await update.message.reply_text(
-            "\n".join(lines),
-            reply_markup=MAIN_KEYBOARD,
+            note + format_tag_page(tag, page["docs"]),
+            reply_markup=get_pagination_keyboard("t", page, tag) or MAIN_KEYBOARD,
             parse_mode="Markdown"
         )
         return
@@ -622,40 +3595,88 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
 
 
+@with_conversation_state
+@timed_handler("callback", callback_route)
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """טיפול בכפתורי inline."""
     query = update.callback_query
     await query.answer()
     
-    if not is_admin(update):
+    if not is_allowed(update):
         return
+    owner_id = owner_of(update)
     
     data = query.data
     
     # ============ אישור שמירה ============
-    if data.startswith("confirm_save"):
+    if data.startswith("confirm_save") or data == "save_anyway":
         draft = context.user_data.get(DRAFT_KEY, {})
         
         if not draft:
             await query.edit_message_text("❌ אין טיוטה לשמירה.", reply_markup=None)
             return
         
-        doc = {
-            "title": draft.get("title", "(ללא כותרת)"),
-            "solution": draft.get("solution", ""),
-            "tags": draft.get("tags", []),
-            "context": "",
-            "code": "",
-        }
+        doc = draft_to_doc(draft, owner_id)
+        
+        if data != "save_anyway":
+            # כברירת מחדל רק hash של התוכן (שאילתה אחת על אינדקס), והשמירה מיידית.
+            # עם DUPLICATE_THRESHOLD > 0 מחכים גם לבדיקה הוקטורית, עד DUPLICATE_CHECK_TIMEOUT;
+            # אם היא לא הספיקה, ה-embedding שלה נשאר ב-cache ל-embedding_worker.
+            try:
+                duplicate = await asyncio.wait_for(find_duplicate_async(doc), DUPLICATE_CHECK_TIMEOUT)
+            except asyncio.TimeoutError:
+                duplicate = None
+            if duplicate:
+                draft["duplicate_id"] = str(duplicate["_id"])
+                context.user_data[DRAFT_KEY] = draft
+                similarity = "תוכן זהה" if duplicate["reason"] == "hash" else f"דמיון {duplicate['score']:.0%}"
+                await query.edit_message_text(
+                    f"⚠️ **נראה שזה כבר שמור** ({similarity}):\n\n"
+                    f"📌 {duplicate.get('title') or '(ללא כותרת)'}\n\n"
+                    "מה לעשות?",
+                    reply_markup=get_duplicate_keyboard(),
+                    parse_mode="Markdown"
+                )
+                return
         
-        memory_id = save_memory(doc)
+        memory_id = await save_memory_async(doc)
         reset_user_state(context)
         
         await query.edit_message_text(
             f"✅ **נשמר בהצלחה!**\n\n"
             f"📌 {doc['title']}\n"
             f"🏷️ {', '.join(doc['tags']) if doc['tags'] else '(ללא תגיות)'}\n\n"
-            f"🔑 ID: `{memory_id}`",
+            f"🔑 ID: `{memory_id}`\n"
+            f"⏳ החיפוש הסמנטי יכלול אותו תוך רגע.",
+            parse_mode="Markdown"
+        )
+        return
+    
+    # ============ מיזוג / עדכון זיכרון כפול ============
+    if data in ("dup_merge", "dup_update"):
+        draft = context.user_data.get(DRAFT_KEY, {})
+        memory_id = draft.get("duplicate_id")
+        
+        if not memory_id:
+            await query.edit_message_text("❌ אין טיוטה לשמירה.", reply_markup=None)
+            return
+        
+        doc = draft_to_doc(draft, owner_id)
+        if data == "dup_merge":
+            ok = await merge_memory_async(owner_id, memory_id, doc)
+            done_text = "🔀 **מוזג לזיכרון הקיים!**"
+        else:
+            ok = await update_memory_async(
+                owner_id, memory_id, {"title": doc["title"], "solution": doc["solution"], "tags": doc["tags"]}
+            )
+            done_text = "♻️ **הזיכרון הקיים עודכן!**"
+        reset_user_state(context)
+        
+        if not ok:
+            await query.edit_message_text("❌ הזיכרון לא נמצא.")
+            return
+        await query.edit_message_text(
+            f"{done_text}\n\n🔑 ID: `{memory_id}`",
             parse_mode="Markdown"
         )
         return
@@ -687,7 +3708,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # ============ הצגת זיכרון מלא ============
     if data.startswith("view_full:"):
         memory_id = data.split(":")[1]
-        doc = get_memory_by_id(memory_id)
+        doc = await get_memory_by_id_async(owner_id, memory_id)
         
         if not doc:
             await query.edit_message_text("❌ הזיכרון לא נמצא.")
@@ -703,7 +3724,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # ============ מחיקת זיכרון ============
     if data.startswith("delete:"):
         memory_id = data.split(":")[1]
-        doc = get_memory_by_id(memory_id)
+        doc = await get_memory_by_id_async(owner_id, memory_id)
         
         if not doc:
             await query.edit_message_text("❌ הזיכרון לא נמצא.")
@@ -730,7 +3751,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if data.startswith("confirm_delete:"):
         memory_id = data.split(":")[1]
         
-        if delete_memory(memory_id):
+        if await delete_memory_async(owner_id, memory_id):
             await query.edit_message_text("✅ הזיכרון נמחק.")
         else:
             await query.edit_message_text("❌ שגיאה במחיקה.")
@@ -743,6 +3764,286 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         reset_user_state(context)
         await query.edit_message_text("❌ המחיקה בוטלה.")
         return
+    
+    # ============ הצעת תגית ============
+    if data.startswith("tag:"):
+        reset_user_state(context)
+        tag = data[len("tag:"):]
+        page = await search_by_tag_page_async(owner_id, tag)
+        
+        if not page["docs"]:
+            await query.edit_message_text(f"😕 לא מצאתי זיכרונות עם התגית `{tag}`.", parse_mode="Markdown")
+            return
+        
+        await query.edit_message_text(
+            format_tag_page(tag, page["docs"]),
+            reply_markup=get_pagination_keyboard("t", page, tag),
+            parse_mode="Markdown"
+        )
+        return
+    
+    # ============ דפדוף (רשימה / תגית) ============
+    if data.startswith("page:"):
+        parts = data.split(":", 4)
+        if len(parts) < 4:
+            return
+        _, kind, direction, cursor = parts[:4]
+        
+        if kind == "t" and len(parts) == 5:
+            tag = parts[4]
+            page = await search_by_tag_page_async(owner_id, tag, cursor=cursor, direction=direction)
+            text = format_tag_page(tag, page["docs"])
+            keyboard = get_pagination_keyboard("t", page, tag)
+        elif kind == "r":
+            page = await get_recent_memories_page_async(owner_id, cursor=cursor, direction=direction)
+            text = format_recent_page(page["docs"])
+            keyboard = get_pagination_keyboard("r", page)
+        else:
+            return
+        
+        if not page["docs"]:
+            await query.edit_message_text("📭 אין עוד זיכרונות.")
+            return
+        
+        await query.edit_message_text(text, reply_markup=keyboard, parse_mode="Markdown")
+        return
+
+
+# ==================== Background Jobs ====================
+
+_background_tasks: List[asyncio.Task] = []
+
+
+async def run_periodically(func: Callable[[], Any], interval_seconds: float, name: str,
+                           first_delay: float = 0) -> None:
+    """הרצת פונקציה חוסמת כל interval_seconds, החל מאחרי first_delay."""
+    await asyncio.sleep(first_delay)
+    while True:
+        try:
+            await run_blocking(func)
+        except Exception as e:
+            logger.error(f"Background job {name} failed: {e}")
+        await asyncio.sleep(interval_seconds)
+
+
+def start_background_job(coro) -> None:
+    """הפעלת משימת רקע שתבוטל בכיבוי."""
+    _background_tasks.append(asyncio.create_task(coro))
+
+
+_embedding_wakeup = asyncio.Event()
+EMBEDDING_WORKER_DEBOUNCE = 0.5  # שניות לאסוף שמירות סמוכות לקבוצה אחת
+
+
+async def embedding_worker() -> None:
+    """
+    משלים embeddings לזיכרונות pending בקבוצות: מיד אחרי שמירה (_embedding_wakeup),
+    ובכל מקרה כל EMBEDDING_BACKFILL_MINUTES (שמירות שנכשלו, או מ-worker אחר).
+    """
+    interval = EMBEDDING_BACKFILL_MINUTES * 60 or None
+    _embedding_wakeup.set()  # סבב ראשון מיד - מה שנשאר pending לפני ה-restart
+    while True:
+        try:
+            await asyncio.wait_for(_embedding_wakeup.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        _embedding_wakeup.clear()
+        await asyncio.sleep(EMBEDDING_WORKER_DEBOUNCE)
+        try:
+            while await run_blocking(backfill_pending_embeddings):
+                pass
+        except Exception as e:
+            logger.error(f"Embedding worker failed: {e}")
+
+
+# ==================== Startup ====================
+# השרת מתחיל לענות מיד; אתחול הבוט, ה-webhook והאינדקסים רצים ברקע.
+# עדכונים שמגיעים בינתיים מחכים בתור עד ש-_bot_ready מסומן.
+
+_bot_ready = asyncio.Event()
+_startup_phases: Dict[str, float] = {}
+
+
+def mark_startup_phase(phase: str) -> None:
+    """רישום הזמן מתחילת התהליך עד לשלב (פעם אחת לכל שלב)."""
+    if phase in _startup_phases:
+        return
+    elapsed = round(time.monotonic() - PROCESS_STARTED, 3)
+    _startup_phases[phase] = elapsed
+    STARTUP_SECONDS.labels(phase).set(elapsed)
+    logger.info(f"Startup phase {phase}: {elapsed:.3f}s")
+
+
+async def initialize_bot() -> None:
+    """אתחול ה-Application של PTB, עם ניסיונות חוזרים אם טלגרם לא זמין."""
+    delay = 1.0
+    while True:
+        try:
+            await ptb_app.initialize()
+            await ptb_app.start()
+            return
+        except Exception as e:
+            logger.error(f"Bot initialization failed, retrying in {delay:.0f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+
+async def warm_up() -> None:
+    """אתחול ברקע אחרי שהשרת כבר מקבל בקשות."""
+    await initialize_bot()
+    _bot_ready.set()
+    mark_startup_phase("bot_ready")
+    
+    webhook_url = f"{PUBLIC_URL}/webhook/{WEBHOOK_SECRET}"
+    try:
+        await ptb_app.bot.set_webhook(url=webhook_url)
+        mark_startup_phase("webhook")
+        logger.info(f"Webhook set to: {webhook_url}")
+    except Exception as e:
+        logger.error(f"Failed to set webhook: {e}")
+    
+    try:
+        await run_blocking(embedding_provider.warm_up)
+        mark_startup_phase("embeddings")
+    except Exception as e:
+        logger.error(f"Embedding provider warm-up failed: {e}")
+    try:
+        # לפני האינדקסים: האינדקסים הייחודיים החדשים מתחילים ב-owner_id
+        await run_blocking(assign_default_owner)
+        await run_blocking(ensure_indexes)
+        mark_startup_phase("indexes")
+    except Exception as e:
+        logger.error(f"Index creation failed: {e}")
+    
+    if SEARCH_BACKEND == "local":
+        await run_blocking(get_local_index)
+        if LOCAL_INDEX_REFRESH_MINUTES > 0:
+            interval = LOCAL_INDEX_REFRESH_MINUTES * 60
+            start_background_job(run_periodically(
+                functools.partial(get_local_index().refresh, memories), interval,
+                "local_index_refresh", first_delay=interval
+            ))
+    
+    try:
+        await run_blocking(tag_index.load, tag_counts)
+    except Exception as e:
+        logger.error(f"Tag index load failed: {e}")
+    if TAG_INDEX_REFRESH_MINUTES > 0:
+        interval = TAG_INDEX_REFRESH_MINUTES * 60
+        start_background_job(run_periodically(
+            functools.partial(tag_index.load, tag_counts), interval, "tag_index_refresh", first_delay=interval
+        ))
+    
+    start_background_job(embedding_worker())
+    
+    if TAG_COUNTS_REBUILD_HOURS > 0:
+        # בפריסה ראשונה (tag_counts ריק) בונים מיד, אחרת רק במחזור הבא
+        interval = TAG_COUNTS_REBUILD_HOURS * 3600
+        try:
+            has_counts = await run_blocking(tag_counts.estimated_document_count)
+        except Exception as e:
+            logger.error(f"Failed to read tag counts: {e}")
+            has_counts = 0
+        start_background_job(run_periodically(
+            rebuild_tag_counts, interval, "rebuild_tag_counts",
+            first_delay=interval if has_counts else 0
+        ))
+
+
+async def process_update(update: Update) -> None:
+    """עיבוד עדכון ב-PTB (ומדידת זמן התגובה הראשונה מאז עליית התהליך)."""
+    await ptb_app.process_update(update)
+    mark_startup_phase("first_update")
+
+
+# ==================== Update Queue ====================
+# ה-webhook מכניס את העדכון לתור ומחזיר 200 מיד. כל worker מחזיק תור משלו,
+# ועדכונים מאותו צ'אט תמיד נכנסים לאותו תור - כך נשמר הסדר בתוך צ'אט.
+# עדכונים כפולים (retry של טלגרם) מזוהים לפי update_id ונזרקים.
+
+class UpdateDispatcher:
+    """תור עדכונים חסום עם מאגר workers."""
+    
+    SEEN_IDS_LIMIT = 10000
+    
+    def __init__(self, process: Callable[[Update], Any], workers: int, queue_size: int):
+        self._process = process
+        self._workers = max(1, workers)
+        self._queue_size = max(1, queue_size // self._workers)
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._seen_ids: "OrderedDict[int, None]" = OrderedDict()
+        self._closing = False
+        self._ready: Optional[asyncio.Event] = None
+    
+    def start(self, ready: Optional[asyncio.Event] = None) -> None:
+        """
+        יצירת התורים וה-workers (בתוך ה-event loop).
+        אם ניתן ready - העדכונים נאספים בתור מיד, אבל מעובדים רק אחרי שהוא מסומן.
+        """
+        self._ready = ready
+        self._queues = [asyncio.Queue(maxsize=self._queue_size) for _ in range(self._workers)]
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+    
+    def _remember(self, update_id: int) -> bool:
+        """רישום update_id. מחזיר False אם כבר נראה."""
+        if update_id in self._seen_ids:
+            return False
+        self._seen_ids[update_id] = None
+        while len(self._seen_ids) > self.SEEN_IDS_LIMIT:
+            self._seen_ids.popitem(last=False)
+        return True
+    
+    def submit(self, update: Update) -> bool:
+        """הכנסת עדכון לתור. מחזיר False אם התור מלא או שהמערכת נסגרת."""
+        if self._closing or not self._queues:
+            return False
+        if update.update_id in self._seen_ids:
+            UPDATE_QUEUE_DUPLICATES.inc()
+            logger.info(f"Duplicate update dropped: {update.update_id}")
+            return True
+        
+        chat = update.effective_chat
+        user = update.effective_user
+        key = chat.id if chat else (user.id if user else update.update_id)
+        queue = self._queues[hash(key) % self._workers]
+        try:
+            queue.put_nowait((update, time.monotonic()))
+        except asyncio.QueueFull:
+            UPDATE_QUEUE_REJECTED.inc()
+            return False
+        self._remember(update.update_id)
+        return True
+    
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        if self._ready is not None:
+            await self._ready.wait()
+        while True:
+            update, enqueued_at = await queue.get()
+            UPDATE_QUEUE_WAIT.observe(time.monotonic() - enqueued_at)
+            try:
+                await self._process(update)
+            except Exception as e:
+                logger.error(f"Update {update.update_id} failed: {e}")
+            finally:
+                queue.task_done()
+    
+    def depth(self) -> int:
+        """מספר העדכונים שממתינים בכל התורים."""
+        return sum(q.qsize() for q in self._queues)
+    
+    async def drain(self, timeout: float) -> None:
+        """הפסקת קבלת עדכונים, המתנה לסיום התור, ועצירת ה-workers."""
+        self._closing = True
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(q.join() for q in self._queues)), timeout
+            )
+        except asyncio.TimeoutError:
+            left = self.depth()
+            logger.warning(f"Update queue drain timed out, {left} updates dropped")
+        for task in self._tasks:
+            task.cancel()
 
 
 # ==================== FastAPI Application ====================
@@ -753,25 +4054,36 @@ ptb_app = Application.builder().token(BOT_TOKEN).build()
 # Register handlers
 ptb_app.add_handler(CommandHandler("start", cmd_start))
 ptb_app.add_handler(CommandHandler("help", cmd_help))
+ptb_app.add_handler(CommandHandler("reembed", cmd_reembed))
 ptb_app.add_handler(CallbackQueryHandler(handle_callback))
 ptb_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+update_dispatcher = UpdateDispatcher(process_update, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+UPDATE_QUEUE_DEPTH.set_function(update_dispatcher.depth)
+
 
 @app.on_event("startup")
 async def on_startup():
-    """הפעלת webhook בעת עלייה."""
-    webhook_url = f"{PUBLIC_URL}/webhook/{WEBHOOK_SECRET}"
-    await ptb_app.bot.set_webhook(url=webhook_url)
-    await ptb_app.initialize()
-    await ptb_app.start()
-    logger.info(f"Webhook set to: {webhook_url}")
+    """עלייה מהירה: התור מוכן מיד, שאר האתחול ברקע (ראו warm_up)."""
+    update_dispatcher.start(ready=_bot_ready)
+    start_background_job(warm_up())
+    mark_startup_phase("app_started")
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
     """סגירה נקייה."""
-    await ptb_app.stop()
+    _reembed_stop.set()
+    await update_dispatcher.drain(UPDATE_DRAIN_TIMEOUT)
+    for task in _background_tasks:
+        task.cancel()
+    if ptb_app.running:
+        await ptb_app.stop()
     await ptb_app.shutdown()
+    if _local_index is not None:
+        await run_blocking(_local_index.save)
+    embedding_provider.close()
+    _blocking_pool.shutdown(wait=False)
 
 
 @app.post("/webhook/{secret:path}")
@@ -782,17 +4094,223 @@ async def telegram_webhook(secret: str, request: Request):
     
     data = await request.json()
     update = Update.de_json(data, ptb_app.bot)
-    await ptb_app.process_update(update)
+    if not update_dispatcher.submit(update):
+        # backpressure: טלגרם ינסה לשלוח שוב מאוחר יותר
+        logger.warning(f"Update queue full, rejecting update {update.update_id}")
+        raise HTTPException(status_code=503, detail="Busy")
     return {"ok": True}
 
 
+def require_admin_token(request: Request) -> None:
+    """בדיקת Authorization: Bearer <ADMIN_API_TOKEN> ל-endpoints ניהוליים."""
+    auth = request.headers.get("authorization", "")
+    token = auth[7:] if auth.lower().startswith("bearer ") else ""
+    if not ADMIN_API_TOKEN or not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+async def iter_request_lines(request: Request) -> AsyncIterator[bytes]:
+    """קריאת גוף הבקשה שורה אחר שורה, בלי לטעון את כולו לזיכרון."""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+@app.post("/import")
+async def api_import(request: Request):
+    """ייבוא זיכרונות בכמות (NDJSON בגוף הבקשה)."""
+    require_admin_token(request)
+    
+    summary = {"inserted": 0, "skipped": 0, "failed": 0, "invalid": 0}
+    batch: List[Dict[str, Any]] = []
+    async for line in iter_request_lines(request):
+        for doc in iter_import_docs([line], summary):
+            batch.append(doc)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            merge_summary(summary, await import_batch_async(batch))
+            batch = []
+    merge_summary(summary, await import_batch_async(batch))
+    
+    logger.info(f"Import finished: {summary}")
+    return summary
+
+
+@app.get("/export")
+def api_export(request: Request, dtype: str = "float16"):
+    """ייצוא כל הזיכרונות כ-NDJSON בזרימה (לשחזור: POST /import)."""
+    require_admin_token(request)
+    if dtype not in EXPORT_DTYPES:
+        raise HTTPException(status_code=400, detail=f"dtype must be one of {EXPORT_DTYPES}")
+    filename = f"memories-{datetime.utcnow():%Y%m%d-%H%M%S}.ndjson"
+    return StreamingResponse(
+        iter_export_lines(dtype),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.get("/admin/reembed")
+async def api_reembed_status(request: Request):
+    """מצב משימת ה-re-embedding."""
+    require_admin_token(request)
+    return await get_reembed_status_async()
+
+
+@app.post("/admin/reembed")
+async def api_reembed_start(request: Request):
+    """הפעלת משימת ה-re-embedding ברקע."""
+    require_admin_token(request)
+    started = await start_reembed_job_async()
+    return {"started": started, **(await get_reembed_status_async())}
+
+
+@app.get("/metrics")
+def metrics():
+    """מדדי Prometheus."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/")
 def health():
-    """בדיקת תקינות."""
+    """בדיקת תקינות (liveness) - עונה מיד, בלי תלות ב-Mongo או בטלגרם."""
     return {"status": "ok", "bot": "Memory Agent"}
 
 
+READY_PING_TIMEOUT = 5.0
+
+
+@app.get("/ready")
+async def ready(response: Response):
+    """בדיקת מוכנות: הבוט אותחל ו-MongoDB עונה."""
+    checks = {"bot": _bot_ready.is_set(), "mongo": False}
+    try:
+        await asyncio.wait_for(run_blocking(ping_mongo), READY_PING_TIMEOUT)
+        checks["mongo"] = True
+    except Exception as e:
+        logger.warning(f"Readiness ping failed: {e}")
+    
+    is_ready = all(checks.values())
+    if not is_ready:
+        response.status_code = 503
+    return {"ready": is_ready, "checks": checks, "startup_seconds": _startup_phases}
+
+
 @app.get("/stats")
-def api_stats():
-    """API לסטטיסטיקות."""
-    return get_stats()
+async def api_stats():
+    """API לסטטיסטיקות (כלל המשתמשים)."""
+    return await run_blocking(get_global_stats)
+
+
+@app.get("/admin/cache-stats")
+async def api_cache_stats(request: Request):
+    """מוני ה-caches (embeddings ומסמכים)."""
+    require_admin_token(request)
+    return {
+        "embedding_cache": get_embedding_cache_stats(),
+        "doc_cache": get_doc_cache_stats()
+    }
+
+
+# ==================== CLI ====================
+
+def cli() -> None:
+    """פקודות ניהול: python main.py <command>."""
+    parser = argparse.ArgumentParser(description="Memory Agent Bot admin commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+    
+    p_import = sub.add_parser("import", aliases=["restore"], help="ייבוא / שחזור זיכרונות מקובץ NDJSON")
+    p_import.add_argument("path", help="נתיב לקובץ NDJSON ('-' ל-stdin)")
+    p_import.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    
+    p_export = sub.add_parser("export", help="ייצוא כל הזיכרונות ל-NDJSON")
+    p_export.add_argument("path", nargs="?", default="-", help="קובץ יעד ('-' ל-stdout)")
+    p_export.add_argument("--dtype", choices=EXPORT_DTYPES, default="float16")
+    
+    sub.add_parser("migrate", help="יצירת האינדקסים ב-MongoDB (חד-פעמי לפני פריסה)")
+    
+    sub.add_parser("rebuild-tag-counts", help="בנייה מחדש של ספירת התגיות")
+    
+    p_storage = sub.add_parser("migrate-storage", help="המרת embeddings קיימים לשיטת אחסון")
+    p_storage.add_argument("--storage", choices=["float", "int8", "binary"], default=EMBEDDING_STORAGE)
+    
+    p_index = sub.add_parser("atlas-index", help="הדפסת הגדרת אינדקס Atlas לפי ההגדרות")
+    p_index.add_argument("--next", action="store_true", help="לשדה של מיגרציית המימדים")
+    
+    sub.add_parser("backfill-next", help="מילוי EMBEDDING_NEXT_FIELD למסמכים קיימים")
+    
+    p_reembed = sub.add_parser("reembed", help="יצירה מחדש של embeddings ישנים (ממשיך מ-checkpoint)")
+    p_reembed.add_argument("--status", action="store_true", help="הצגת מצב בלבד")
+    
+    p_qreport = sub.add_parser("quantization-report", help="recall מול גודל לכל שיטת אחסון")
+    p_qreport.add_argument("--sample", type=int, default=1000)
+    p_qreport.add_argument("--queries", type=int, default=50)
+    p_qreport.add_argument("-k", type=int, default=5)
+    
+    p_recall = sub.add_parser("eval-recall", help="recall@k של החיפוש הוקטורי מול brute force")
+    p_recall.add_argument("--queries", type=int, default=50)
+    p_recall.add_argument("-k", type=int, default=5)
+    p_recall.add_argument("--candidates", default="", help="ערכי numCandidates להשוואה, למשל 50,100,400")
+    
+    args = parser.parse_args()
+    
+    if args.command in ("import", "restore"):
+        if args.path == "-":
+            summary = bulk_import(sys.stdin, args.batch_size)
+        else:
+            with open(args.path, "r", encoding="utf-8") as f:
+                summary = bulk_import(f, args.batch_size)
+        print(json.dumps(summary, ensure_ascii=False))
+    
+    elif args.command == "export":
+        if args.path == "-":
+            sys.stdout.writelines(iter_export_lines(args.dtype))
+        else:
+            with open(args.path, "w", encoding="utf-8") as f:
+                f.writelines(iter_export_lines(args.dtype))
+    
+    elif args.command == "migrate":
+        assigned = assign_default_owner()
+        ensure_indexes()
+        print(f"indexes ok, {assigned} memories assigned to admin, "
+              f"{backfill_content_hashes()} content hashes added")
+    
+    elif args.command == "rebuild-tag-counts":
+        print(f"{rebuild_tag_counts()} tags")
+    
+    elif args.command == "migrate-storage":
+        print(f"{migrate_embedding_storage(args.storage)} documents converted")
+    
+    elif args.command == "atlas-index":
+        if args.next:
+            if not EMBEDDING_NEXT_FIELD:
+                parser.error("EMBEDDING_NEXT_FIELD is not set")
+            name = vector_index_name(f"{VECTOR_INDEX_NAME}_{EMBEDDING_NEXT_FIELD}")
+            definition = build_vector_index_definition(EMBEDDING_NEXT_FIELD, EMBEDDING_NEXT_DIMENSIONS)
+        else:
+            name = vector_index_name()
+            definition = build_vector_index_definition()
+        print(f"// Index name: {name}  (collection: {DB_NAME}.memories)")
+        print(json.dumps(definition, indent=2))
+    
+    elif args.command == "backfill-next":
+        print(f"{backfill_next_embeddings()} documents backfilled")
+    
+    elif args.command == "reembed":
+        status = get_reembed_status() if args.status else run_reembed_job()
+        print(json.dumps(status, indent=2, ensure_ascii=False))
+    
+    elif args.command == "quantization-report":
+        print(json.dumps(quantization_report(args.sample, args.queries, args.k), indent=2))
+    
+    elif args.command == "eval-recall":
+        candidates = [int(n) for n in args.candidates.split(",") if n.strip()]
+        print(json.dumps(eval_recall(args.queries, args.k, candidates), indent=2, default=str))
+
+
+if __name__ == "__main__":
+    cli()